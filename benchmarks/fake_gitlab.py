@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Local stand-in for the gitlab endpoints the bot uses (api v4, web sign-in
+and the html blame page) and for slack's chat.postMessage, with injectable
+latency and errors. Every request is counted by route.
+'''
+import re
+import json
+import time
+import zlib
+import base64
+import random
+import threading
+from collections import Counter
+from functools import lru_cache
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from benchmarks import generators
+
+HEAD_SHA = 'a' * 40
+CONFIG_BLOB = 'c' * 40
+SLACK_PREFIX = '/slack/api/'
+
+_API = r'^/api/v4'
+_PROJECT = _API + r'/projects/(?P<project>[^/]+)'
+_MR = _PROJECT + r'/merge_requests/(?P<iid>\d+)'
+
+ROUTES = [(name, method, re.compile(pattern)) for name, method, pattern in [
+    ('sign_in', 'GET', r'^/users/sign_in$'),
+    ('sign_in', 'POST', r'^/users/auth/ldapmain/callback$'),
+    ('users', 'GET', _API + r'/users$'),
+    ('branch', 'GET', _PROJECT + r'/repository/branches/(?P<branch>[^/]+)$'),
+    ('file', 'GET', _PROJECT + r'/repository/files/(?P<path>[^/]+)$'),
+    ('file', 'HEAD', _PROJECT + r'/repository/files/(?P<path>[^/]+)$'),
+    ('compare', 'GET', _PROJECT + r'/repository/compare$'),
+    ('mr', 'GET', _MR + r'$'),
+    ('mr_update', 'PUT', _MR + r'$'),
+    ('mr_versions', 'GET', _MR + r'/versions$'),
+    ('mr_version', 'GET', _MR + r'/versions/(?P<version>\d+)$'),
+    ('mr_diffs', 'GET', _MR + r'/diffs$'),
+    ('notes', 'GET', _MR + r'/notes$'),
+    ('note_create', 'POST', _MR + r'/notes$'),
+    ('blame', 'GET', r'^/(?P<namespace>.+?)/blame/(?P<ref>[^/]+)/(?P<path>.+)$'),
+    ('slack', 'POST', '^' + SLACK_PREFIX + r'chat\.postMessage$'),
+]]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists from python 3.7
+    daemon_threads = True
+
+
+def namespace_of(project_id):
+    return 'load/project{}'.format(project_id)
+
+
+def bot_config():
+    return {
+        'maxReviewers': 3,
+        'numFilesToCheck': 5,
+        'actions': ['open', 'reopen'],
+        'labels': {
+            '': 'load',
+            'pyapp/': 'pyapp'
+        },
+        'labelNotifications': {
+            'load': '#load'
+        },
+        'skipAlreadyMentionedMR': True,
+    }
+
+
+class FakeGitlab(object):
+    '''
+    `latency` (+ up to `jitter`) seconds are spent on every gitlab request,
+    and `error_rate` of them answer 500; `slack_latency` and
+    `slack_error_rate` do the same for slack. MRs have `files` changed
+    files, blames have `blame_lines` lines. `on_slack(text)` is called for
+    every message posted to slack.
+    '''
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, slack_latency=0,
+                 slack_error_rate=0, files=10, blame_lines=2000,
+                 on_slack=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slack_latency = slack_latency
+        self.slack_error_rate = slack_error_rate
+        self.files = files
+        self.blame_lines = blame_lines
+        self.on_slack = on_slack
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def slack_url(self):
+        return self.url + SLACK_PREFIX
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(_Handler):
+            server_fake = fake
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _delay_and_fail(self, route):
+        is_slack = route == 'slack'
+        latency = self.slack_latency if is_slack else self.latency
+        error_rate = self.slack_error_rate if is_slack else self.error_rate
+        with self._lock:
+            self.calls[route] += 1
+            delay = latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < error_rate
+            if fail:
+                self.errors[route] += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    @lru_cache(maxsize=4096)
+    def changes(self, project_id, iid):
+        return generators.make_diff(self.files, 4, 12,
+                                    seed=int(project_id) * 100003 + iid)
+
+    @lru_cache(maxsize=1024)
+    def blame(self, namespace, path):
+        return generators.make_blame_html(self.blame_lines, 40,
+                                          zlib.crc32(path.encode()))
+
+    def merge_request(self, project_id, iid, labels=()):
+        return {
+            'id': iid,
+            'iid': iid,
+            'project_id': project_id,
+            'title': 'loadtest',
+            'state': 'opened',
+            'labels': list(labels),
+            'sha': HEAD_SHA,
+        }
+
+    def handle(self, route, method, params, query, body):
+        '''
+        Returns (status, headers, body) for a matched route.
+        '''
+        if route == 'sign_in':
+            return 200, {'Content-Type': 'text/html'}, (
+                '<input type="hidden" name="authenticity_token" '
+                'value="loadtest-token" />')
+        if route == 'blame':
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, \
+                self.blame(params['namespace'], params['path'])
+        if route == 'slack':
+            if self.on_slack:
+                self.on_slack(parse_qs(body).get('text', [''])[0])
+            return 200, {}, {'ok': True, 'ts': str(time.time())}
+        if route == 'users':
+            usernames = query.get('username') or generators.AUTHORS
+            return 200, {}, [{
+                'id': i,
+                'username': name,
+                'state': 'active'
+            } for i, name in enumerate(usernames)]
+        project_id = unquote(params['project'])
+        if route == 'branch':
+            return 200, {}, {
+                'name': unquote(params['branch']),
+                'commit': {
+                    'id': HEAD_SHA
+                }
+            }
+        if route == 'file':
+            content = json.dumps(bot_config()).encode()
+            return 200, {'X-Gitlab-Blob-Id': CONFIG_BLOB}, {
+                'file_path': unquote(params['path']),
+                'blob_id': CONFIG_BLOB,
+                'content': base64.b64encode(content).decode(),
+                'encoding': 'base64',
+            }
+        if route == 'compare':
+            return 200, {}, {'commits': [], 'diffs': []}
+        iid = int(params['iid'])
+        if route == 'mr':
+            return 200, {}, self.merge_request(project_id, iid)
+        if route == 'mr_update':
+            labels = json.loads(body or '{}').get('labels') or ''
+            if isinstance(labels, str):
+                labels = [x for x in labels.split(',') if x]
+            return 200, {}, self.merge_request(project_id, iid, labels)
+        if route == 'mr_versions':
+            return 200, {}, [{'id': 1, 'base_commit_sha': HEAD_SHA}]
+        if route == 'mr_version':
+            return 200, {}, {
+                'id': 1,
+                'base_commit_sha': HEAD_SHA,
+                'diffs': self.changes(project_id, iid),
+            }
+        if route == 'mr_diffs':
+            return 200, {}, self.changes(project_id, iid)
+        if route == 'notes':
+            return 200, {}, []
+        if route == 'note_create':
+            note = json.loads(body or '{}')
+            return 201, {}, {'id': 1, 'body': note.get('body', '')}
+        return 404, {}, {'message': '404 Not found'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        for route, route_method, pattern in ROUTES:
+            matched = pattern.match(parts.path)
+            if matched and route_method == method:
+                break
+        else:
+            return self._reply(method, 404, {}, {'message': '404 Not found'})
+        fake = self.server_fake
+        if fake._delay_and_fail(route):
+            return self._reply(method, 500, {}, {'message': 'injected error'})
+        status, headers, data = fake.handle(route, method,
+                                            matched.groupdict(),
+                                            parse_qs(parts.query), body)
+        self._reply(method, status, headers, data)
+
+    def _reply(self, method, status, headers, data):
+        if not isinstance(data, str):
+            headers = dict({'Content-Type': 'application/json'}, **headers)
+            data = json.dumps(data)
+        payload = data.encode('utf-8')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Synthetic inputs shaped like what gitlab sends us: MR diffs, blame pages
+and .mention-bot label rules. Everything is seeded, so a given size always
+produces the same data.
+'''
+import random
+
+AUTHORS = ['user{}'.format(i) for i in range(200)]
+DIRS = ['pyapp/box', 'pyapp/chewy', 'pyapp/gore', 'pyapp/risk', 'fpga/core',
+        'ccgh/src', 'pylib/util', 'vendor/lib', 'jsgh/web', 'ghui/alice',
+        'risk/engine', 'protobuf/gen']
+
+# name -> arguments of the generators below
+SIZES = {
+    'realistic': {
+        'files': 30,
+        'hunks': 4,
+        'hunk_lines': 12,
+        'blame_lines': 2000,
+        'blame_commits': 60,
+        'rules': 30,
+    },
+    'extreme': {
+        'files': 2000,
+        'hunks': 20,
+        'hunk_lines': 40,
+        'blame_lines': 100000,
+        'blame_commits': 5000,
+        'rules': 2000,
+    },
+}
+
+
+def make_paths(count, seed=0):
+    rnd = random.Random(seed)
+    return [
+        '{}/{}/module_{}.py'.format(rnd.choice(DIRS), rnd.randint(0, 50), i)
+        for i in range(count)
+    ]
+
+
+def make_file_diff(hunks, hunk_lines, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    from_line = 1
+    for _ in range(hunks):
+        from_line += rnd.randint(5, 200)
+        removed = rnd.randint(0, hunk_lines // 2)
+        added = rnd.randint(0, hunk_lines // 2)
+        context = hunk_lines - removed - added
+        lines.append('@@ -{},{} +{},{} @@ def handler(self):'.format(
+            from_line, context + removed, from_line, context + added))
+        body = ([' ctx = {}'.format(i) for i in range(context)] +
+                ['-old = {}'.format(i) for i in range(removed)] +
+                ['+new = {}'.format(i) for i in range(added)])
+        rnd.shuffle(body)
+        lines.extend(body)
+        from_line += context + removed
+    return '\n'.join(lines) + '\n'
+
+
+def make_diff(files, hunks, hunk_lines, seed=0):
+    '''
+    Changes as returned by gitlab_client.get_merge_request_diff.
+    '''
+    return [{
+        'old_path': path,
+        'new_path': path,
+        'diff': make_file_diff(hunks, hunk_lines, seed + i),
+    } for i, path in enumerate(make_paths(files, seed))]
+
+
+_BLAME_COMMIT = '''<tr>
+<td class="blame-commit">
+<div class="commit">
+<a class="commit-sha" href="/group/project/commit/{sha}">{short}</a>
+<div class="light">
+<a class="commit-author-link has-tooltip" title="{author}@example.com" href="/{author}">{author}</a>
+committed
+<time class="js-timeago" title="" datetime="{date}" data-toggle="tooltip">{date}</time>
+</div>
+</div>
+</td>
+<td class="line-numbers">
+'''
+_BLAME_LINE = '''<a class="diff-line-num" data-line-number="{n}" href="#L{n}" id="L{n}">
+<i aria-hidden="true" data-hidden="true" class="fa fa-link"></i>
+{n}
+</a>
+'''
+_BLAME_CODE = '''</td>
+<td class="lines">
+<pre class="code highlight"><code>{code}</code></pre>
+</td>
+</tr>
+'''
+
+
+def make_blame_html(lines, commits, seed=0):
+    '''
+    A gitlab blame page of `lines` lines split into `commits` blocks.
+    '''
+    rnd = random.Random(seed)
+    cuts = sorted(rnd.sample(range(1, lines), min(commits, lines) - 1))
+    parts = ['<table class="blame">\n']
+    start = 1
+    for end in cuts + [lines + 1]:
+        sha = '{:040x}'.format(rnd.getrandbits(160))
+        parts.append(
+            _BLAME_COMMIT.format(sha=sha,
+                                 short=sha[:8],
+                                 author=rnd.choice(AUTHORS),
+                                 date='20{:02d}-{:02d}-{:02d}T10:00:00Z'.format(
+                                     rnd.randint(10, 24), rnd.randint(1, 12),
+                                     rnd.randint(1, 28))))
+        parts.extend(_BLAME_LINE.format(n=n) for n in range(start, end))
+        parts.append(
+            _BLAME_CODE.format(code='\n'.join('x = {}'.format(n)
+                                             for n in range(start, end))))
+        start = end
+    parts.append('</table>\n')
+    return ''.join(parts)
+
+
+def make_blames(files, lines, seed=0):
+    '''
+    {path: [author per line]} for the (path, deleted lines) in `files`.
+    '''
+    rnd = random.Random(seed)
+    return {
+        path: [rnd.choice(AUTHORS[:40]) for _ in range(lines)]
+        for path, _ in files
+    }
+
+
+def make_label_config(rules, seed=0):
+    '''
+    A .mention-bot `labels` mapping of path prefix -> label.
+    '''
+    rnd = random.Random(seed)
+    prefixes = list(DIRS) + [
+        '{}/{}'.format(rnd.choice(DIRS), i) for i in range(rules)
+    ]
+    return {
+        prefix: 'label-{}'.format(rnd.randint(0, rules // 3 + 1))
+        for prefix in prefixes[:max(rules, 1)]
+    }
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+End-to-end load test: merge request webhooks are replayed at a given rate
+against the bot, which talks to a local fake gitlab and slack. An event is
+done once its slack notification arrives.
+
+    python -m benchmarks.loadtest --events 200 --rate 20
+    python -m benchmarks.loadtest --events 500 --rate 0 --latency 0.05 \\
+        --error-rate 0.01 --json loadtest.json
+
+The bot runs in this process unless --bot-url points at one started with
+GITLAB_URL and SLACK_API_URL set to the urls printed at startup.
+'''
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import threading
+import logging
+
+import requests
+
+from benchmarks import generators
+from benchmarks.fake_gitlab import FakeGitlab, namespace_of
+
+MARKER = 'loadtest-'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * len(values))))]
+
+
+def make_payload(template, n, projects):
+    payload = copy.deepcopy(template)
+    project_id = n % projects + 1
+    obj = payload['object_attributes']
+    obj.update({
+        'iid': n + 1,
+        'id': n + 1,
+        'action': 'open',
+        'work_in_progress': False,
+        'target_project_id': project_id,
+        'source_project_id': project_id,
+        'title': '{}{}-'.format(MARKER, n),
+        'url': 'http://gitlab.local/{}/merge_requests/{}'.format(
+            namespace_of(project_id), n + 1),
+    })
+    obj['target']['path_with_namespace'] = namespace_of(project_id)
+    payload['user']['username'] = generators.AUTHORS[n %
+                                                     len(generators.AUTHORS)]
+    return payload
+
+
+class Tracker(object):
+    '''
+    Send and completion times of every event, completion being the first
+    slack message that carries the event's marker.
+    '''
+
+    def __init__(self):
+        self.sent = {}
+        self.done = {}
+        self.rejected = 0
+        # events the bot gave up on; only known when it runs in-process
+        self.failed = lambda: 0
+        self._cond = threading.Condition()
+
+    def on_slack(self, text):
+        start = text.find(MARKER)
+        if start < 0:
+            return
+        n = int(text[start + len(MARKER):].split('-', 1)[0])
+        with self._cond:
+            self.done.setdefault(n, time.monotonic())
+            self._cond.notify_all()
+
+    def wait(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.done) + self.failed() < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.5))
+        return True
+
+    def latencies(self):
+        return [self.done[n] - self.sent[n] for n in self.done
+                if n in self.sent]
+
+
+def _configure_bot_env(fake, args):
+    # read by mention.config at import, so set before the bot is imported.
+    # endpoints, credentials and state files always point at the fakes, so a
+    # shell set up for the real bot can't send synthetic events to gitlab or
+    # slack; tuning knobs already in the environment are kept
+    os.environ.update({
+        'GITLAB_URL': fake.url,
+        'GITLAB_TOKEN': 'loadtest',
+        'GITLAB_USERNAME': 'loadtest',
+        'GITLAB_PASSWORD': 'loadtest',
+        'SLACK_TOKEN': 'loadtest',
+        'SLACK_API_URL': fake.slack_url,
+        'QUEUE_JOURNAL_PATH': '',
+        'BLAME_CACHE_PATH': '',
+    })
+    os.environ.setdefault('PAYLOAD_DELAY', '0')
+
+
+def _start_bot(tracker, fake, args):
+    from werkzeug.serving import make_server
+    from mention import config
+    if (config.GITLAB_URL, config.SLACK_API_URL) != (fake.url,
+                                                     fake.slack_url):
+        raise RuntimeError('mention.config was loaded before the load test '
+                           'configured it, refusing to run against {}'.format(
+                               config.GITLAB_URL))
+    from mention.app import app
+    from mention import metrics
+    tracker.failed = lambda: metrics.events_total.value(
+        kind='merge_request', outcome='error')
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{}/'.format(server.server_port)
+
+
+def replay(bot_url, tracker, args):
+    with open('tests/data/merge_request_event.json') as f:
+        template = json.load(f)
+    payloads = [make_payload(template, n, args.projects)
+                for n in range(args.events)]
+    session = requests.Session()
+    headers = {'X-Gitlab-Event': 'Merge Request Hook'}
+    started = time.monotonic()
+    for n, payload in enumerate(payloads):
+        if args.rate:
+            delay = started + n / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        tracker.sent[n] = time.monotonic()
+        response = session.post(bot_url, data=json.dumps(payload),
+                                headers=headers)
+        if response.status_code != 200:
+            tracker.rejected += 1
+    return started
+
+
+def report(fake, tracker, started, args):
+    latencies = tracker.latencies()
+    finished = max(tracker.done.values()) if tracker.done else started
+    elapsed = finished - started
+    completed = len(tracker.done)
+    gitlab_calls = sum(n for route, n in fake.calls.items()
+                       if route != 'slack')
+    result = {
+        'events': args.events,
+        'completed': completed,
+        'rejected': tracker.rejected,
+        'failed': tracker.failed(),
+        'seconds': elapsed,
+        'events_per_second': completed / elapsed if elapsed > 0 else None,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+        },
+        'gitlab_calls_per_event': gitlab_calls / completed
+        if completed else None,
+        'calls': dict(fake.calls),
+        'injected_errors': dict(fake.errors),
+    }
+
+    print('events: {} sent, {} done, {} rejected, {} failed in {:.2f}s'.format(
+        args.events, completed, tracker.rejected, result['failed'], elapsed))
+    if result['events_per_second']:
+        print('throughput: {:.2f} events/s'.format(
+            result['events_per_second']))
+    if latencies:
+        print('end to end: p50={p50:.3f}s p90={p90:.3f}s p99={p99:.3f}s '
+              'max={max:.3f}s'.format(**result['latency']))
+    if completed:
+        print('gitlab calls per event: {:.1f}'.format(
+            result['gitlab_calls_per_event']))
+    for route, n in sorted(fake.calls.items()):
+        print('  {:<12} {:>7} calls  {:>7.2f}/event  {} errors'.format(
+            route, n, n / max(completed, 1), fake.errors.get(route, 0)))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=10,
+                        help='events per second, 0 sends them all at once')
+    parser.add_argument('--projects', type=int, default=5)
+    parser.add_argument('--files', type=int, default=10,
+                        help='changed files per MR')
+    parser.add_argument('--blame-lines', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds per gitlab request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of gitlab requests answering 500')
+    parser.add_argument('--slack-latency', type=float, default=0.0)
+    parser.add_argument('--slack-error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for the last event')
+    parser.add_argument('--bot-url')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port of the fake gitlab')
+    parser.add_argument('--json', help='also write the results here')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    tracker = Tracker()
+    fake = FakeGitlab(args.latency, args.jitter, args.error_rate,
+                      args.slack_latency, args.slack_error_rate, args.files,
+                      args.blame_lines, tracker.on_slack).start(
+                          port=args.port)
+    print('fake gitlab at {}, slack at {}'.format(fake.url, fake.slack_url))
+    try:
+        if args.bot_url:
+            bot_url = args.bot_url
+        else:
+            _configure_bot_env(fake, args)
+            bot_url = _start_bot(tracker, fake, args)
+        started = replay(bot_url, tracker, args)
+        if not tracker.wait(args.events - tracker.rejected, args.timeout):
+            print('timed out waiting for {} events'.format(
+                args.events - tracker.rejected - tracker.failed() -
+                len(tracker.done)))
+        result = report(fake, tracker, started, args)
+    finally:
+        fake.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 0 if len(tracker.done) == args.events else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Micro-benchmarks of the parsing and ranking hot paths.
+
+    python -m benchmarks.run                     # realistic sizes
+    python -m benchmarks.run --size extreme -k blame
+    python -m benchmarks.run --compare HEAD~1    # against a stored run
+
+Each run is saved as benchmarks/results/<commit>.json, so a run of an
+older checkout can be compared with the current one.
+'''
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import statistics
+import subprocess
+import logging
+
+import mock
+
+from mention import mention_bot
+from mention import gitlab_client
+from benchmarks import generators
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(
+            ('git', ) + args, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _cases(size):
+    '''
+    Yields (name, fn) pairs; fn is timed with all of its inputs prebuilt.
+    '''
+    s = generators.SIZES[size]
+    changes = generators.make_diff(s['files'], s['hunks'], s['hunk_lines'])
+    diff_text = changes[0]['diff']
+    files = mention_bot.parse_diff(changes)
+    blame_html = generators.make_blame_html(s['blame_lines'],
+                                            s['blame_commits'])
+    top_files = mention_bot.filter_files(files, [], 5)
+    blames = generators.make_blames(top_files, s['blame_lines'])
+    cfg = mention_bot.BotConfig.from_dict({
+        'labels': generators.make_label_config(s['rules']),
+        'fileBlacklist': ['*.md', 'vendor/*', '*_pb2.py', 'protobuf/*'],
+        'maxReviewers': 3,
+    })
+
+    yield 'parse_diff', lambda: mention_bot.parse_diff(changes)
+    yield 'get_deleted_lines', lambda: mention_bot.get_deleted_lines(
+        diff_text)
+    yield 'parse_blame', lambda: mention_bot.parse_blame(blame_html)
+    yield 'get_deleted_owners', lambda: mention_bot.get_deleted_owners(
+        top_files, blames)
+    yield 'get_all_owners', lambda: mention_bot.get_all_owners(
+        top_files, blames)
+    yield 'guess_owners', lambda: mention_bot.guess_owners(
+        top_files, blames, 'user0', cfg)
+    yield 'filter_files', lambda: mention_bot.filter_files(
+        files, cfg.fileBlacklist, 5)
+    yield 'get_labels', lambda: gitlab_client.get_labels(cfg, files)
+    yield 'get_labels_cold', lambda: gitlab_client.get_labels(
+        mention_bot.BotConfig.from_dict({'labels': dict(cfg.labels)}), files)
+
+
+def _time(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    runs = [t / number for t in timer.repeat(repeat, number)]
+    return {
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(sizes, pattern=None, repeat=5, min_time=0.2):
+    results = {}
+    # guess_owners checks reviewers against the gitlab user list, and the
+    # hot paths log at INFO; neither is what is measured here
+    with mock.patch('mention.user_directory.is_active', return_value=True):
+        logging.disable(logging.CRITICAL)
+        try:
+            for size in sizes:
+                for name, fn in _cases(size):
+                    key = '{}[{}]'.format(name, size)
+                    if pattern and pattern not in key:
+                        continue
+                    results[key] = _time(fn, repeat, min_time)
+                    print('{:<32} {:>12.1f} us  (median {:.1f} us)'.format(
+                        key, results[key]['min'] * 1e6,
+                        results[key]['median'] * 1e6))
+        finally:
+            logging.disable(logging.NOTSET)
+    return results
+
+
+def save(results, directory=RESULTS_DIR):
+    commit = _git('rev-parse', 'HEAD') or 'unknown'
+    dirty = bool(_git('status', '--porcelain', '--untracked-files=no'))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory,
+                        commit + ('-dirty' if dirty else '') + '.json')
+    stored = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+    stored.setdefault('results', {}).update(results)
+    stored.update({
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    with open(path, 'w') as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+    return path
+
+
+def load(ref, directory=RESULTS_DIR):
+    '''
+    Stored results of a commit-ish (resolved with git) or a json file.
+    '''
+    if os.path.isfile(ref):
+        path = ref
+    else:
+        commit = _git('rev-parse', ref) or ref
+        path = os.path.join(directory, commit + '.json')
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(baseline, results, threshold):
+    '''
+    Prints the change of every benchmark against `baseline` and returns the
+    names that got slower by more than `threshold` (0.1 = 10%).
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['min'] / baseline[key]['min']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('{:<32} {:>12.1f} us -> {:>12.1f} us  {:+.1%}{}'.format(
+            key, baseline[key]['min'] * 1e6, results[key]['min'] * 1e6,
+            ratio - 1, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size',
+                        choices=sorted(generators.SIZES) + ['all'],
+                        default='realistic')
+    parser.add_argument('-k', dest='pattern', help='only names containing it')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds per repeat')
+    parser.add_argument('--compare', metavar='COMMIT_OR_FILE')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    sizes = sorted(generators.SIZES) if args.size == 'all' else [args.size]
+    results = run(sizes, args.pattern, args.repeat, args.min_time)
+    if not args.no_save:
+        print('saved to {}'.format(save(results)))
+    if args.compare:
+        regressions = compare(load(args.compare), results, args.threshold)
+        if regressions:
+            print('{} benchmarks regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,14 +4,13 @@ import os
 import json
 import logging
 from queue import Queue, Empty
-from threading import Thread
+from threading import Thread, Lock
 import datetime
-import math
 import time
 import argparse
 import copy
 
-from flask import Flask, request
+from flask import Flask, request, send_file
 
 ## setup logging
 
@@ -20,51 +19,38 @@ subparsers = parser.add_subparsers(help='Startup Mode')
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-listen', action='store_true', default=False)
 group.add_argument('-quick-check', action='store_true', default=False)
+parser.add_argument('-log-format', choices=['text', 'json'], default=None)
 
 args = parser.parse_args() if __name__ == '__main__' else None
 
-import logging.config
-logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'basic': {
-            'format':
-            '%(levelname)s %(asctime)s %(filename)s:%(lineno)d '
-            '%(message)s'
-        },
-    },
-    'handlers': {
-        'console': {
-            'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
-            'formatter': 'basic'
-        },
-        'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'formatter': 'basic',
-            'filename': '/tmp/mention-bot-hook.log'
-            if args and args.listen else '/tmp/mention-bot-checks.log',
-            'maxBytes': 100*1024*1024,
-            'backupCount': 30
-        }
-    },
-    'root': {
-        'level': 'INFO',
-        'handlers': ['console', 'file']
-    }
-})
+from mention import config
+from mention import logs
+logs.setup((args and args.log_format) or config.LOG_FORMAT,
+           '/tmp/mention-bot-hook.log'
+           if args and args.listen else '/tmp/mention-bot-checks.log',
+           config.LOG_MAX_FIELD, config.LOG_SAMPLE_RATE)
 logger = logging.getLogger()
 
 ## end logging setup
 from mention import gitlab_client
 from mention import mention_bot
-from mention import config
+from mention import config_cache
 from mention import helper
+from mention import notify
+from mention import user_directory
+from mention import ownership_index
+from mention import metrics
+from mention.profiling import profiler
+from mention.journal import journal
+from mention.scheduler import DelayScheduler
 
 app = Flask(__name__)
 _STOP_PROCESS = False
-enclosure_queue = Queue()
+# one queue per worker; events of the same MR always hash to the same lane
+# so they are still handled in order
+enclosure_queues = [Queue() for _ in range(config.PAYLOAD_WORKERS)]
+_workers = []
+_workers_lock = Lock()
 
 
 @app.route('/check_health', methods=['GET'])
@@ -72,6 +58,61 @@ def check_health():
     return "mention-bot"
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.registry.render(), 200, {
+        'Content-Type': metrics.CONTENT_TYPE
+    }
+
+
+def _json_response(data, status=200):
+    return json.dumps(data), status, {'Content-Type': 'application/json'}
+
+
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+    if not config.DEBUG_ROUTES:
+        return '', 404
+    return _json_response(dict(profiler.status(), profiles=profiler.list()))
+
+
+@app.route('/debug/profiles', methods=['POST'])
+def arm_profiler():
+    '''
+    Profiles the next `jobs` payload jobs, only counting those of
+    `project_id` if given. `mode` is cprofile or sample.
+    '''
+    if not config.DEBUG_ROUTES:
+        return '', 404
+    try:
+        data = json.loads(request.data or '{}')
+        if not isinstance(data, dict):
+            raise ValueError('expected a json object')
+        profiler.arm(int(data.get('jobs', 1)), data.get('project_id'),
+                     data.get('mode', 'cprofile'))
+    except (ValueError, TypeError) as e:
+        return _json_response({'error': str(e)}, 400)
+    except OSError as e:
+        return _json_response({'error': str(e)}, 500)
+    return _json_response(profiler.status())
+
+
+@app.route('/debug/profiles', methods=['DELETE'])
+def disarm_profiler():
+    if not config.DEBUG_ROUTES:
+        return '', 404
+    profiler.disarm()
+    return _json_response(profiler.status())
+
+
+@app.route('/debug/profiles/<name>', methods=['GET'])
+def get_profile(name):
+    path = profiler.path(name) if config.DEBUG_ROUTES else None
+    if path is None:
+        return '', 404
+    return send_file(path, as_attachment=True)
+
+
 @app.route('/', methods=['GET'])
 def mentionbot():
     return "Gitlab Mention Bot active"
@@ -82,21 +123,168 @@ def webhook():
     event = request.headers.get('X-Gitlab-Event')
     if not event:
         return '', 400
+    if event == 'Push Hook':
+        payload = json.loads(request.data)
+        config_cache.invalidate_for_push(payload)
+        if ownership_index.index.wants(payload):
+            _enqueue(payload)
+        return '', 200
     if event != 'Merge Request Hook':
         return '', 200
 
     # add payload to queue so that _payload_worker(q) can process it in
     # a separate thread
     payload = json.loads(request.data)
-    enclosure_queue.put((datetime.datetime.now(), payload))
+    _enqueue(payload)
 
     return "", 200
 
 
+def _payload_key(payload):
+    if payload.get('object_kind') == 'push':
+        return payload['project_id'], payload['ref']
+    obj = payload['object_attributes']
+    return obj['target_project_id'], obj['iid']
+
+
+def _payload_delay(payload):
+    if payload.get('object_kind') == 'push':
+        action = 'push'
+    else:
+        action = payload['object_attributes'].get('action')
+    return config.PAYLOAD_DELAYS.get(action, config.PAYLOAD_DELAY)
+
+
+# when several events of one MR are coalesced, the job keeps the action
+# that matters most: a merge or close ends the MR, and an open must still
+# get its reviewer comment even if updates follow.
+_ACTION_STRENGTH = ['update', 'reopen', 'open', 'close', 'closed', 'merge']
+
+
+def _stronger_action(a, b):
+    strength = lambda x: _ACTION_STRENGTH.index(x) \
+        if x in _ACTION_STRENGTH else -1
+    return a if strength(a) > strength(b) else b
+
+
+def _coalesce(job, payload, ids):
+    action = _stronger_action(job['payload']['object_attributes']['action'],
+                              payload['object_attributes']['action'])
+    job['payload'] = dict(payload,
+                          object_attributes=dict(payload['object_attributes'],
+                                                 action=action))
+    job['due'] = max(job['due'], time.monotonic() + _payload_delay(payload))
+    job['events'] += 1
+    job['ids'].extend(ids)
+
+
+def _dispatch(job):
+    # a coalesced event may have pushed the job back, wait for it too
+    if job['due'] > time.monotonic():
+        scheduler.schedule(job['due'], job)
+        return
+    with _pending_lock:
+        if _pending.get(job['key']) is job:
+            del _pending[job['key']]
+    if job['events'] > 1:
+        logger.info('Coalesced {} events for {}'.format(job['events'],
+                                                        job['key']))
+    lane = enclosure_queues[hash(job['key']) % len(enclosure_queues)]
+    lane.put((job['received'], job['payload'], job['ids']))
+
+
+# holds events until they are old enough, see config.PAYLOAD_DELAY
+scheduler = DelayScheduler(_dispatch)
+# MR events that are scheduled but not handed to a lane yet, by MR
+_pending = {}
+_pending_lock = Lock()
+
+
+def _lane_lag():
+    # seconds since the oldest event still waiting on a lane was received
+    now = datetime.datetime.now()
+    lag = 0
+    for q in enclosure_queues:
+        with q.mutex:
+            if q.queue:
+                lag = max(lag, (now - q.queue[0][0]).total_seconds())
+    return lag
+
+
+metrics.registry.gauge('mention_queue_lag_seconds',
+                       'Age of the oldest event waiting for a payload worker',
+                       fn=_lane_lag)
+metrics.registry.gauge(
+    'mention_queue_depth', 'Events waiting for a payload worker, per lane',
+    ['lane'],
+    lambda: {(i, ): q.qsize()
+             for i, q in enumerate(enclosure_queues)})
+metrics.registry.gauge('mention_scheduled_events',
+                       'Events waiting out their processing delay',
+                       fn=lambda: len(scheduler))
+
+
+def _schedule(payload, received, ids, age=0):
+    key = _payload_key(payload)
+    due = time.monotonic() + max(_payload_delay(payload) - age, 0)
+    with _pending_lock:
+        job = _pending.get(key)
+        if job and payload.get('object_kind') != 'push' and \
+           (received - job['received']).total_seconds() <= \
+           config.COALESCE_WINDOW:
+            _coalesce(job, payload, ids)
+            return
+        if job:
+            # a shorter delay must not overtake an earlier event of the MR
+            due = max(due, job['due'])
+        job = {
+            'key': key,
+            'received': received,
+            'payload': payload,
+            'due': due,
+            'events': 1,
+            'ids': list(ids),
+        }
+        if payload.get('object_kind') != 'push':
+            _pending[key] = job
+    scheduler.schedule(job['due'], job)
+
+
+def _enqueue(payload):
+    ids = []
+    # gunicorn never calls main(), so make sure somebody is listening
+    if not app.testing:
+        start_workers()
+        if journal.enabled:
+            ids.append(journal.append(payload))
+    _schedule(payload, datetime.datetime.now(), ids)
+
+
+def _replay_journal():
+    now = time.time()
+    events = journal.pending()
+    for event_id, received, payload in events:
+        _schedule(payload, datetime.datetime.fromtimestamp(received),
+                  [event_id], now - received)
+    if events:
+        logger.info('Replayed {} events from the journal'.format(len(events)))
+
+
+def _replay_loop():
+    # events of a process that died are replayed here once its lease lapses
+    while not _STOP_PROCESS:
+        time.sleep(config.QUEUE_JOURNAL_LEASE)
+        try:
+            _replay_journal()
+        except Exception:
+            logger.exception('journal replay failed')
+
+
 def _manage_payload(payload):
     logger.info('_' * 80)
-    logger.info('Received payload<{}>: {}'.format(
-        id(payload), helper.load_dict_as_yaml(payload)))
+    logger.info('Received payload<%s>: %s', id(payload),
+                logs.lazy(helper.load_dict_as_yaml, payload),
+                extra=logs.VERBOSE)
     username = payload['user']['username']
     project_id = payload['object_attributes']['target_project_id']
     target_branch = payload['object_attributes']['target_branch']
@@ -105,79 +293,121 @@ def _manage_payload(payload):
     # loading config
     logger.info('Current Action={}'.format(
         payload['object_attributes']['action']))
+    ctx = gitlab_client.RequestContext()
     try:
-        cfg = mention_bot.get_repo_config(project_id, target_branch,
-                                          config.CONFIG_PATH)
+        with metrics.stage('config'):
+            cfg = config_cache.get_repo_config(project_id, target_branch,
+                                               config.CONFIG_PATH, ctx)
 
-        diff_files = mention_bot.get_diff_files(project_id, merge_request_id)
-        logging.info(
-            f'PiD: {project_id}, IID: {merge_request_id}; files={diff_files}')
+        with metrics.stage('diff'):
+            diff_files = mention_bot.get_diff_files(project_id,
+                                                    merge_request_id, ctx)
+        logger.info('PiD: %s, IID: %s; files=%s', project_id,
+                    merge_request_id, diff_files, extra=logs.VERBOSE)
 
         if mention_bot.is_valid(cfg, payload):
             owners = mention_bot.guess_owners_for_merge_reqeust(
                 project_id, namespace, target_branch, merge_request_id,
-                username, cfg, diff_files)
+                username, cfg, diff_files, ctx)
             if owners:
                 logging.info(f'owners = {owners}; username={username}')
-                mention_bot.add_comment(project_id, merge_request_id, username,
-                                        owners, cfg)
+                with metrics.stage('comment'):
+                    mention_bot.add_comment(project_id, merge_request_id,
+                                            username, owners, cfg, ctx)
             else:
                 logging.info(f'No Owners found: PiD:{project_id}; MID:{merge_request_id}, username: {username}')
 
         if payload['object_attributes']['action'] in [
                 'open', 'reopen', 'closed', 'close', 'merge'
         ]:
-            mention_bot.manage_labels(payload, project_id, merge_request_id,
-                                      cfg, diff_files)
+            with metrics.stage('labels'):
+                mention_bot.manage_labels(payload, project_id,
+                                          merge_request_id, cfg, diff_files,
+                                          ctx)
     except gitlab_client.ConfigSyntaxError as e:
         gitlab_client.add_comment_merge_request(project_id, merge_request_id,
-                                                e.message)
+                                                str(e), ctx)
+    finally:
+        logger.info('PiD: {}, IID: {}; gitlab api calls={}; {}'.format(
+            project_id, merge_request_id, ctx.total_api_calls,
+            dict(ctx.api_calls)))
 
 
-def _check_and_sleep(ts):
-    now = datetime.datetime.now()
-    exp_ts = datetime.timedelta(seconds=10) + ts
-    if exp_ts > now:
-        should_wait = math.ceil((exp_ts - now).total_seconds())
-        if should_wait:
-            logger.info('ts={}; now={}; sleeping for: {}'.format(
-                ts, now, should_wait))
-            time.sleep(should_wait)
+def _manage_push(payload):
+    logger.info('Received push<{}>: project={}; ref={}; {}..{}'.format(
+        id(payload), payload['project_id'], payload['ref'],
+        payload['before'], payload['after']))
+    ownership_index.update_from_push(payload)
 
 
 def _payload_worker(q):
-    # this worker is needed solely because sometimes the MR comes in too fast,
-    # and gitlab queries fail. So let's add a delay of 10s, to ensure that
-    # all updates work.
+    # payloads only reach the lanes once the scheduler considers them old
+    # enough, since sometimes the MR comes in too fast and gitlab queries
+    # fail.
     logger.info('Looking for next payload')
     global _STOP_PROCESS
     while not _STOP_PROCESS:
         try:
-            payload_ts, payload = q.get(timeout=2)
+            payload_ts, payload, journal_ids = q.get(timeout=2)
+            kind = payload.get('object_kind', 'merge_request')
+            waited = datetime.datetime.now() - payload_ts
+            metrics.event_wait_seconds.observe(waited.total_seconds(),
+                                               kind=kind)
             logger.info('Looking for next payload')
-            logger.info('Payload found: at ts={}; id={}'.format(
-                payload_ts, id(payload)))
-            _check_and_sleep(payload_ts)
+            logger.info('Payload found: at ts={}; id={}; waited={}'.format(
+                payload_ts, id(payload), waited))
+            handle = _manage_push if kind == 'push' else _manage_payload
             try:
-              _manage_payload(payload)
+              journal.start(journal_ids)
+              if profiler.armed:
+                  profiler.run(handle, payload)
+              else:
+                  handle(payload)
+              # failed events stay in the journal and are retried on restart
+              journal.ack(journal_ids)
+              metrics.events_total.inc(kind=kind, outcome='ok')
             except Exception as e:
+              metrics.events_total.inc(kind=kind, outcome='error')
               logger.error(f'Exception with the message: {str(e)}')
             q.task_done()
         except Empty:
             pass
 
+def start_workers():
+    with _workers_lock:
+        if _workers:
+            return
+        # warm the active user list before the first MR needs it
+        user_directory.directory.refresh_async()
+
+        # setup threads to handle the payloads
+        if journal.enabled:
+            _replay_journal()
+            replayer = Thread(target=_replay_loop)
+            replayer.daemon = True
+            replayer.start()
+        scheduler.start()
+        for q in enclosure_queues:
+            worker = Thread(target=_payload_worker, args=(q, ))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+        logger.info('Started {} payload workers'.format(len(_workers)))
+
+
 def main():
-    # setup thread to handle the payloads
-    worker = Thread(target=_payload_worker, args=(enclosure_queue, ))
-    worker.setDaemon(True)
-    worker.start()
+    start_workers()
 
     app.run(host='0.0.0.0')
     global _STOP_PROCESS
     _STOP_PROCESS = True
-    logger.info('Stopping worker...')
-    worker.join()
-    logger.info('worker stopped...')
+    logger.info('Stopping workers...')
+    scheduler.stop()
+    for worker in _workers:
+        worker.join()
+    notify.digest.flush_all()
+    notify.outbox.join(timeout=10)
+    logger.info('workers stopped...')
 
 
 if __name__ == '__main__':
@@ -187,3 +417,5 @@ if __name__ == '__main__':
         main()
     if args.quick_check:
         mention_bot.check_merge_requests('p/higgs')
+        notify.digest.flush_all()
+        notify.outbox.join(timeout=60)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+
+from mention import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blames (
+    namespace TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    path TEXT NOT NULL,
+    authors BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (namespace, commit_sha, path)
+)
+'''
+
+
+class BlameCache(object):
+    '''
+    On-disk store of parsed blames (one author per line) keyed by
+    (namespace, commit_sha, path). The blame of a file at a given commit
+    never changes, so entries are only dropped, least recently used first,
+    once the stored authors exceed `max_bytes`. A hit only records its use
+    once the entry has gone `touch_interval` seconds without one.
+    '''
+
+    def __init__(self, path, max_bytes, touch_interval=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._conn = None
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+            self._total = self._stored_bytes(self._conn)
+        return self._conn
+
+    def _stored_bytes(self, conn):
+        return conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blames').fetchone()[0]
+
+    def get(self, namespace, commit_sha, path):
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT authors, last_used FROM blames '
+                'WHERE namespace=? AND commit_sha=? AND path=?',
+                (namespace, commit_sha, path)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] >= self.touch_interval:
+                conn.execute(
+                    'UPDATE blames SET last_used=? '
+                    'WHERE namespace=? AND commit_sha=? AND path=?',
+                    (now, namespace, commit_sha, path))
+                conn.commit()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, namespace, commit_sha, path, authors):
+        if not self.enabled:
+            return
+        data = zlib.compress(json.dumps(authors).encode('utf-8'))
+        with self._lock:
+            conn = self._connect()
+            replaced = conn.execute(
+                'SELECT size FROM blames '
+                'WHERE namespace=? AND commit_sha=? AND path=?',
+                (namespace, commit_sha, path)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO blames VALUES (?, ?, ?, ?, ?, ?)',
+                (namespace, commit_sha, path, data, len(data), time.time()))
+            self._total += len(data) - (replaced[0] if replaced else 0)
+            if self._total > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        # other processes may share the file, so recount before dropping
+        total = self._stored_bytes(conn)
+        evicted = []
+        if total > self.max_bytes:
+            for rowid, size in conn.execute(
+                    'SELECT rowid, size FROM blames ORDER BY last_used'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((rowid, ))
+                total -= size
+            conn.executemany('DELETE FROM blames WHERE rowid=?', evicted)
+            logger.info('blame cache evicted {} entries'.format(len(evicted)))
+        self._total = total
+
+
+cache = BlameCache(config.BLAME_CACHE_PATH,
+                   config.BLAME_CACHE_MAX_MB * 1024 * 1024)
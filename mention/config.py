@@ -9,9 +9,83 @@ GITLAB_TOKEN = os.getenv('GITLAB_TOKEN')
 GITLAB_USERNAME = os.getenv('GITLAB_USERNAME')
 GITLAB_PASSWORD = os.getenv('GITLAB_PASSWORD')
 SLACK_TOKEN = os.getenv('SLACK_TOKEN')
+# base of the slack web api, only changed to point the bot at a stand-in
+SLACK_API_URL = os.getenv('SLACK_API_URL') or 'https://slack.com/api/'
 CONFIG_PATH = '.mention-bot'
 
 
+def _parse_mapping(value):
+    # "open=10,update=20" -> {'open': 10, 'update': 20}
+    pairs = [x.split('=', 1) for x in (value or '').split(',') if '=' in x]
+    return {k.strip(): int(v) for k, v in pairs}
+
+
+# seconds an event waits before it is processed, since gitlab queries made
+# right after an MR event sometimes fail. PAYLOAD_DELAYS overrides it per
+# action, e.g. PAYLOAD_DELAYS=merge=0,update=20
+PAYLOAD_DELAY = int(os.getenv('PAYLOAD_DELAY') or 10)
+PAYLOAD_DELAYS = dict({'push': 0}, **_parse_mapping(os.getenv('PAYLOAD_DELAYS')))
+# MR events arriving within this many seconds of a still pending event of
+# the same MR are merged into it; 0 disables coalescing
+COALESCE_WINDOW = int(os.getenv('COALESCE_WINDOW') or 30)
+# sqlite log of received events, replayed after a restart; '' disables it
+QUEUE_JOURNAL_PATH = os.getenv('QUEUE_JOURNAL_PATH',
+                               '/tmp/mention-bot-queue.sqlite')
+# processing attempts of an unacked event before it is dropped
+QUEUE_JOURNAL_MAX_ATTEMPTS = int(os.getenv('QUEUE_JOURNAL_MAX_ATTEMPTS') or 3)
+# seconds after which the events of a process that stopped renewing its
+# claim are replayed by another one
+QUEUE_JOURNAL_LEASE = int(os.getenv('QUEUE_JOURNAL_LEASE') or 60)
+# unfinished events older than this many seconds are dropped, not replayed
+# against an MR that has moved on; 0 replays them at any age
+QUEUE_JOURNAL_MAX_AGE = int(os.getenv('QUEUE_JOURNAL_MAX_AGE') or 3600)
+# threads processing webhook events; events of one MR stay on one thread
+PAYLOAD_WORKERS = int(os.getenv('PAYLOAD_WORKERS') or 4)
+# http transport shared by the gitlab api client and blame scraping
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE') or 16)
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT') or 5)
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT') or 60)
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES') or 3)
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF') or 0.5)
+# retries allowed as a fraction of recent requests, plus a fixed minimum
+HTTP_RETRY_BUDGET = float(os.getenv('HTTP_RETRY_BUDGET') or 0.2)
+HTTP_RETRY_BUDGET_MIN = int(os.getenv('HTTP_RETRY_BUDGET_MIN') or 5)
+# threads posting to slack, and attempts per message before it is dropped
+SLACK_WORKERS = int(os.getenv('SLACK_WORKERS') or 2)
+SLACK_MAX_ATTEMPTS = int(os.getenv('SLACK_MAX_ATTEMPTS') or 5)
+# upper bound on blame requests in flight across all merge requests
+BLAME_MAX_CONCURRENCY = int(os.getenv('BLAME_MAX_CONCURRENCY') or 8)
+# seconds before the cached list of active gitlab users is refreshed
+USER_DIRECTORY_TTL = int(os.getenv('USER_DIRECTORY_TTL') or 15 * 60)
+# seconds a cached .mention-bot is trusted before its blob id is rechecked
+CONFIG_REVALIDATE_TTL = int(os.getenv('CONFIG_REVALIDATE_TTL') or 60)
+# sqlite file holding parsed blames per commit; set to '' to disable
+BLAME_CACHE_PATH = os.getenv('BLAME_CACHE_PATH',
+                             '/tmp/mention-bot-blame.sqlite')
+BLAME_CACHE_MAX_MB = int(os.getenv('BLAME_CACHE_MAX_MB') or 256)
+# parse blame pages as they download instead of reading them whole
+BLAME_STREAMING = os.getenv('BLAME_STREAMING', '') == '1'
+# fetch MR diffs page by page instead of as one document
+DIFF_STREAMING = os.getenv('DIFF_STREAMING', '') == '1'
+# bare mirrors used by repos configured with "blameBackend": "mirror"
+GIT_MIRROR_DIR = os.getenv('GIT_MIRROR_DIR') or '/tmp/mention-bot-mirrors'
+# seconds before a git clone, fetch or blame of a mirror is killed
+GIT_TIMEOUT = int(os.getenv('GIT_TIMEOUT') or 300)
+# lines whose authors are kept up to date from push events, across files
+OWNERSHIP_INDEX_MAX_LINES = int(os.getenv('OWNERSHIP_INDEX_MAX_LINES') or
+                                2000000)
+# 'text' or 'json' (one object per line, large fields cut to LOG_MAX_FIELD
+# characters); LOG_SAMPLE_RATE is the share of verbose records kept, such as
+# payload dumps and raw blames
+LOG_FORMAT = os.getenv('LOG_FORMAT') or 'text'
+LOG_MAX_FIELD = int(os.getenv('LOG_MAX_FIELD') or 4096)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE') or 1)
+# where profiles of payload jobs are saved once profiling is armed through
+# the /debug/profiles routes, which only exist with DEBUG_ROUTES=1
+PROFILE_DIR = os.getenv('PROFILE_DIR') or '/tmp/mention-bot-profiles'
+DEBUG_ROUTES = os.getenv('DEBUG_ROUTES', '') == '1'
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import logging
+import threading
+
+from mention import config
+from mention import mention_bot
+from mention import gitlab_client
+
+logger = logging.getLogger(__name__)
+
+_NULL_SHA = '0' * 40
+
+
+class ConfigCache(object):
+    '''
+    Parsed BotConfig per (project_id, target_branch, blob_id).
+
+    The blob id of the config file on a branch is revalidated with a cheap
+    HEAD request once it is older than `ttl` seconds, or right away after a
+    push touching the config file. The file itself is only downloaded and
+    parsed when its blob id changes.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._configs = {}
+        self._blob_ids = {}
+        self._lock = threading.Lock()
+
+    def _get_blob_id(self, project_id, target_branch, config_path, ctx=None):
+        key = (project_id, target_branch, config_path)
+        cached = self._blob_ids.get(key)
+        if cached and time.time() - cached[1] <= self.ttl:
+            return cached[0]
+        blob_id = gitlab_client.get_project_file_blob_id(
+            project_id, target_branch, config_path, ctx)
+        with self._lock:
+            if cached and cached[0] != blob_id:
+                self._configs.pop((project_id, target_branch, cached[0]), None)
+            self._blob_ids[key] = (blob_id, time.time())
+        return blob_id
+
+    def get(self, project_id, target_branch, config_path, ctx=None):
+        blob_id = self._get_blob_id(project_id, target_branch, config_path,
+                                    ctx)
+        key = (project_id, target_branch, blob_id)
+        cfg = self._configs.get(key)
+        if cfg is not None:
+            return cfg
+        if blob_id is None:
+            logger.warning(
+                "Unable to find config file, use default config instead.")
+            cfg = mention_bot.BotConfig.from_dict(config.get_default_config())
+        else:
+            cfg = mention_bot.get_repo_config(project_id, target_branch,
+                                              config_path, ctx)
+        logger.info('config cached: project={}; branch={}; blob={}'.format(
+            project_id, target_branch, blob_id))
+        with self._lock:
+            self._configs[key] = cfg
+        return cfg
+
+    def invalidate(self, project_id, target_branch):
+        with self._lock:
+            for key in [k for k in self._blob_ids
+                        if k[:2] == (project_id, target_branch)]:
+                blob_id, _ = self._blob_ids.pop(key)
+                self._configs.pop((project_id, target_branch, blob_id), None)
+
+
+def _push_touches(payload, path):
+    if payload.get('total_commits_count', 0) > len(payload['commits']):
+        # gitlab truncates the commit list, so we can't tell what changed
+        return True
+    if payload.get('after') == _NULL_SHA:
+        return True
+    for commit in payload['commits']:
+        if any(path in commit.get(k, [])
+               for k in ('added', 'modified', 'removed')):
+            return True
+    return False
+
+
+cache = ConfigCache(config.CONFIG_REVALIDATE_TTL)
+
+
+def get_repo_config(project_id, target_branch, config_path, ctx=None):
+    return cache.get(project_id, target_branch, config_path, ctx)
+
+
+def invalidate_for_push(payload, config_path=config.CONFIG_PATH):
+    branch = payload['ref'].split('refs/heads/', 1)[-1]
+    if _push_touches(payload, config_path):
+        logger.info('config invalidated: project={}; branch={}'.format(
+            payload['project_id'], branch))
+        cache.invalidate(payload['project_id'], branch)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import re
+import base64
+import logging
+import threading
+import subprocess
+from collections import defaultdict
+from urllib.parse import urlsplit, urlunsplit
+
+from mention import config
+
+logger = logging.getLogger(__name__)
+
+RE_PORCELAIN_HEADER = re.compile(r'^([0-9a-f]{40}) (\d+) (\d+)')
+
+_mirror_locks = defaultdict(threading.Lock)
+
+
+def mirror_path(namespace):
+    return os.path.join(config.GIT_MIRROR_DIR, namespace + '.git')
+
+
+def clone_url(namespace):
+    # no credentials here: the url ends up in the mirror's config, in the
+    # argv of git and in its errors, which get logged
+    parts = urlsplit(config.GITLAB_URL)
+    return urlunsplit((parts.scheme, parts.netloc, '/{}.git'.format(namespace),
+                       '', ''))
+
+
+def _auth_env():
+    '''
+    Environment passing the gitlab token to git as an http header, for the
+    commands that talk to gitlab.
+    '''
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if config.GITLAB_TOKEN:
+        credentials = base64.b64encode('oauth2:{}'.format(
+            config.GITLAB_TOKEN).encode()).decode()
+        env.update({
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'http.extraHeader',
+            'GIT_CONFIG_VALUE_0': 'Authorization: Basic ' + credentials,
+        })
+    return env
+
+
+def _git(*args, cwd=None, env=None):
+    return subprocess.run(['git'] + list(args),
+                          cwd=cwd,
+                          env=env,
+                          check=True,
+                          timeout=config.GIT_TIMEOUT,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode(
+                              'utf-8', 'replace')
+
+
+def _has_commit(path, commit_sha):
+    try:
+        _git('cat-file', '-e', commit_sha + '^{commit}', cwd=path)
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+def ensure_mirror(namespace, commit_sha=None):
+    '''
+    Make sure the bare mirror of `namespace` exists and contains
+    `commit_sha`. Without a sha we can't tell if the mirror is current, so it
+    is always fetched.
+    '''
+    path = mirror_path(namespace)
+    with _mirror_locks[namespace]:
+        if not os.path.exists(path):
+            logger.info('cloning mirror of {} into {}'.format(namespace, path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _git('clone', '--mirror', '--quiet', clone_url(namespace), path,
+                 env=_auth_env())
+        elif commit_sha is None or not _has_commit(path, commit_sha):
+            logger.info('fetching mirror of {}'.format(namespace))
+            # also drops the token older mirrors kept in their remote url
+            _git('remote', 'set-url', 'origin', clone_url(namespace), cwd=path)
+            _git('fetch', '--prune', '--quiet', 'origin', cwd=path,
+                 env=_auth_env())
+    return path
+
+
+def author_username(email):
+    # gitlab usernames follow the local part of the (LDAP) email address
+    return email.strip('<>').split('@', 1)[0] or 'none'
+
+
+def parse_porcelain(output, dated=False):
+    '''
+    Turns `git blame --porcelain` output into {final_line: author}, or
+    {final_line: [author, committed_at]} if `dated`.
+    '''
+    authors = {}
+    commit_authors = {}
+    commit_times = {}
+    current = None
+    for line in output.split('\n'):
+        if line.startswith('\t'):
+            continue
+        matched = RE_PORCELAIN_HEADER.match(line)
+        if matched:
+            current = matched.group(1)
+            final_line = int(matched.group(3))
+            authors[final_line] = current
+        elif line.startswith('author-mail '):
+            commit_authors[current] = author_username(line[len('author-mail '):])
+        elif line.startswith('committer-time '):
+            commit_times[current] = int(line[len('committer-time '):])
+    if dated:
+        return {
+            final_line: [commit_authors.get(sha, 'none'),
+                         commit_times.get(sha)]
+            for final_line, sha in authors.items()
+        }
+    return {
+        final_line: commit_authors.get(sha, 'none')
+        for final_line, sha in authors.items()
+    }
+
+
+def blame(namespace, ref, path, line_ranges=None, dated=False):
+    '''
+    Author per line of `path` at `ref`, in the same shape as parse_blame
+    (or parse_dated_blame if `dated`). With `line_ranges` ([(start, end)],
+    1-based and inclusive) only those lines are blamed and the others are
+    reported as 'none'.
+    '''
+    args = ['blame', '--porcelain']
+    for start, end in line_ranges or []:
+        args += ['-L', '{},{}'.format(start, end)]
+    try:
+        output = _git(*(args + [ref, '--', path]), cwd=mirror_path(namespace))
+    except subprocess.SubprocessError as e:
+        logger.warning('git blame failed: {}@{}:{}; {}'.format(
+            namespace, ref, path,
+            (e.stderr or str(e).encode()).decode('utf-8', 'replace')))
+        return []
+    authors = parse_porcelain(output, dated)
+    if not authors:
+        return []
+    missing = ['none', None] if dated else 'none'
+    return [authors.get(i, missing) for i in range(1, max(authors) + 1)]
@@ -5,13 +5,18 @@ import re
 import logging
 import pprint
 import base64
-from itertools import chain
+import threading
+from collections import Counter
 
 import sys, os
+from urllib.parse import quote
 
 import requests
 from gitlab import Gitlab
+from gitlab.exceptions import GitlabHttpError
 
+from mention import transport
+from mention import metrics
 from mention.config import GITLAB_URL, GITLAB_TOKEN
 from mention.config import GITLAB_USERNAME, GITLAB_PASSWORD
 
@@ -19,6 +24,9 @@ logger = logging.getLogger(__name__)
 
 session = None
 _gitlab_client = None
+# payload lanes and the user directory refresh all start at once; the
+# session is only published once its login is done
+_login_lock = threading.RLock()
 
 
 class GitlabError(Exception):
@@ -29,6 +37,33 @@ class ConfigSyntaxError(Exception):
     pass
 
 
+class RequestContext(object):
+    '''
+    Per event state for the gitlab helpers: memoizes the project and merge
+    request objects so one event doesn't fetch them again for every step,
+    and counts the gitlab api calls made on its behalf.
+    '''
+
+    def __init__(self):
+        self.projects = {}
+        self.merge_requests = {}
+        self.api_calls = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.api_calls[name] += 1
+
+    @property
+    def total_api_calls(self):
+        return sum(self.api_calls.values())
+
+
+def _count(ctx, name):
+    if ctx is not None:
+        ctx.count(name)
+
+
 def get_pretty_print(item, depth=None):
     pp = pprint.PrettyPrinter(indent=4, depth=depth)
     return pp.pformat(item)
@@ -49,56 +84,112 @@ def get_payload_labels(payload):
             for l in payload[u'labels']] if u'labels' in payload else []
 
 
+class LabelMatcher(object):
+    '''
+    The path prefix -> label rules of a config compiled into a character
+    trie, so the labels of a path are found in one walk along the path
+    instead of trying every rule.
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._root = ({}, set())
+        for prefix, label in rules.items():
+            node = self._root
+            for c in prefix:
+                node = node[0].setdefault(c, ({}, set()))
+            node[1].add(label)
+
+    def match(self, path):
+        node = self._root
+        labels = set(node[1])
+        for c in path:
+            node = node[0].get(c)
+            if node is None:
+                break
+            labels.update(node[1])
+        return labels
+
+
+def get_label_matcher(cfg):
+    # cached on the config itself, which config_cache keeps per blob
+    matcher = getattr(cfg, '_label_matcher', None)
+    if matcher is None or matcher.rules is not cfg.labels:
+        matcher = cfg._label_matcher = LabelMatcher(cfg.labels)
+    return matcher
+
+
 def get_labels(cfg, files):
-    labels_to_add = []
+    matcher = get_label_matcher(cfg)
+    labels_to_add = set()
     files_to_use = [x[0] for x in files]
-    for file in files_to_use:
-        for path, label in cfg.labels.items():
-            if file.startswith(path):
-                labels_to_add.append(label)
-    labels_to_return = sorted([x for x in list(set(labels_to_add))])
+    for file in set(files_to_use):
+        labels_to_add.update(matcher.match(file))
+    labels_to_return = sorted(labels_to_add)
     logger.info(f'labels={labels_to_return}; files={files_to_use}')
     return labels_to_return
 
 
 def get_gitlab_client():
-    global session
-    setup_cookie()
     global _gitlab_client
-    if _gitlab_client is None:
-        logger.info('creating session first time')
-        if session:
-            logger.info(f'Using session: token={GITLAB_TOKEN}')
+    if _gitlab_client is not None:
+        return _gitlab_client
+    with _login_lock:
+        setup_cookie()
+        if _gitlab_client is None:
+            # setup_cookie() always leaves a transport session behind, even
+            # if the web login failed, so the api and blame share one pool
+            logger.info('creating gitlab client first time')
             _gitlab_client = Gitlab(GITLAB_URL,
                                     api_version='4',
                                     private_token=GITLAB_TOKEN,
-                                    session=session)
-        else:
-            logger.info(f'Not using session. Token={GITLAB_TOKEN}')
-            _gitlab_client = Gitlab(GITLAB_URL,
-                                    api_version='4',
-                                    private_token=GITLAB_TOKEN)
+                                    session=session,
+                                    timeout=transport.get_timeout())
     return _gitlab_client
 
 
-def get_project(project_id):
-    client = get_gitlab_client()
-    project = client.projects.get(project_id)
-    return project
-
-
-def get_merge_request(project_id, merge_request_id):
-    project = get_project(project_id)
+@metrics.timed_call
+def get_project(project_id, ctx=None):
+    if ctx is None:
+        client = get_gitlab_client()
+        return client.projects.get(project_id)
+    if project_id not in ctx.projects:
+        # the helpers only need the project to reach its sub resources, so
+        # a lazy object saves the request
+        client = get_gitlab_client()
+        ctx.projects[project_id] = client.projects.get(project_id, lazy=True)
+    return ctx.projects[project_id]
+
+
+@metrics.timed_call
+def get_branch_head(project_id, branch, ctx=None):
+    project = get_project(project_id, ctx)
+    _count(ctx, 'branches.get')
+    return project.branches.get(branch).attributes[u'commit'][u'id']
+
+
+@metrics.timed_call
+def get_merge_request(project_id, merge_request_id, ctx=None):
+    key = (project_id, merge_request_id)
+    if ctx is not None and key in ctx.merge_requests:
+        return ctx.merge_requests[key]
+    project = get_project(project_id, ctx)
+    _count(ctx, 'mergerequests.get')
     mr = project.mergerequests.get(merge_request_id)
+    if ctx is not None:
+        ctx.merge_requests[key] = mr
     return mr
 
 
-def add_comment_merge_request(project_id, merge_request_id, note):
-    merge_request = get_merge_request(project_id, merge_request_id)
+@metrics.timed_call
+def add_comment_merge_request(project_id, merge_request_id, note, ctx=None):
+    merge_request = get_merge_request(project_id, merge_request_id, ctx)
+    _count(ctx, 'notes.create')
     res = merge_request.notes.create({u'body': note})
     return res.attributes
 
 
+@metrics.timed_call
 def get_active_users():
     client = get_gitlab_client()
     return [
@@ -107,6 +198,15 @@ def get_active_users():
     ]
 
 
+@metrics.timed_call
+def is_active_user(username, ctx=None):
+    client = get_gitlab_client()
+    _count(ctx, 'users.list')
+    return any(u.attributes[u'state'] == u'active'
+               for u in client.users.list(username=username))
+
+
+@metrics.timed_call
 def get_blocked_users():
     client = get_gitlab_client()
     # for u in client.users.list(all=True):
@@ -119,8 +219,10 @@ def get_blocked_users():
     return blocked_users
 
 
-def update_labels(project_id, merge_request_id, labels_list):
-    merge_request = get_merge_request(project_id, merge_request_id)
+@metrics.timed_call
+def update_labels(project_id, merge_request_id, labels_list, ctx=None):
+    merge_request = get_merge_request(project_id, merge_request_id, ctx)
+    _count(ctx, 'mergerequests.save')
     merge_request.labels = labels_list
     merge_request.save()
     # client = get_gitlab_client()
@@ -130,48 +232,123 @@ def update_labels(project_id, merge_request_id, labels_list):
     # return 'kk'
 
 
+@metrics.timed_call
 def get_merge_request_plain_changes(project_id, merge_request_id):
     mr = get_merge_request(project_id, merge_request_id)
     commits = mr.commits()
-    changes = ''
-    for d in commits:
-        # logger.info('commit = {}'.format(d.diff()))
-        ch = '\n'.join([x[u'diff'] for x in d.diff()])
-        changes += ch
-    return changes
+    return ''.join('\n'.join(x[u'diff'] for x in d.diff()) for d in commits)
 
 
-def get_merge_request_diff(project_id, merge_request_id):
-    mr = get_merge_request(project_id, merge_request_id)
-    diffs = mr.diffs.list(all=True)
-    uniq_diffs = set()
-    changes = []
-    for d in diffs:
-        diff = mr.diffs.get(d.attributes[u'id'])
-        if diff.attributes[u'base_commit_sha'] not in uniq_diffs:
-            uniq_diffs.add(diff.attributes[u'base_commit_sha'])
-            logger.info('adding for ' + diff.attributes[u'base_commit_sha'])
-            changes.append(diff.attributes[u'diffs'])
-        # logger.info('diff = {}'.format(diff.attributes[u'diffs'][u'diff']))
-    changes = list(chain(*changes))
-    # logger.info('changes = {}'.format(changes))
-    return changes
-
-
-def has_mention_comment(project_id, merge_request_id, comment):
-    merge_request = get_merge_request(project_id, merge_request_id)
+@metrics.timed_call
+def get_merge_request_diff(project_id, merge_request_id, ctx=None):
+    '''
+    File diffs of the latest version of the MR. Versions are listed newest
+    first and each one already holds the whole MR diff against its base, so
+    older versions are never downloaded.
+    '''
+    mr = get_merge_request(project_id, merge_request_id, ctx)
+    _count(ctx, 'diffs.list')
+    versions = mr.diffs.list(per_page=1)
+    if not versions:
+        return []
+    _count(ctx, 'diffs.get')
+    latest = mr.diffs.get(versions[0].attributes[u'id'])
+    logger.info('using diff version for ' +
+                latest.attributes[u'base_commit_sha'])
+    return latest.attributes[u'diffs']
+
+
+@metrics.timed_call
+def iter_merge_request_diff(project_id, merge_request_id, ctx=None,
+                            per_page=50):
+    '''
+    Same file diffs as get_merge_request_diff, fetched page by page from the
+    paginated MR diffs api, so very large MRs never sit in memory at once.
+    Falls back to get_merge_request_diff on gitlab versions without it.
+    '''
+    client = get_gitlab_client()
+    path = '/projects/%s/merge_requests/%s/diffs' % (
+        quote(str(project_id), safe=''), merge_request_id)
+    page = 1
+    while page:
+        _count(ctx, 'diffs.page')
+        try:
+            response = client.http_request('get',
+                                           path,
+                                           query_data={
+                                               'page': page,
+                                               'per_page': per_page
+                                           })
+        except GitlabHttpError as e:
+            if e.response_code == 404 and page == 1:
+                yield from get_merge_request_diff(project_id,
+                                                  merge_request_id, ctx)
+                return
+            raise
+        for diff in response.json():
+            yield diff
+        page = response.headers.get('X-Next-Page')
+        page = int(page) if page else None
+
+
+@metrics.timed_call
+def get_compare(project_id, from_sha, to_sha, ctx=None):
+    '''
+    The compare api response for the diff of `from_sha` to `to_sha` itself,
+    not from their merge base.
+    '''
+    project = get_project(project_id, ctx)
+    _count(ctx, 'repository_compare')
+    return project.repository_compare(from_sha, to_sha, straight='true')
+
+
+@metrics.timed_call
+def is_ancestor(project_id, ancestor_sha, sha, ctx=None):
+    project = get_project(project_id, ctx)
+    _count(ctx, 'repository_merge_base')
+    merge_base = project.repository_merge_base([ancestor_sha, sha])
+    return merge_base[u'id'] == ancestor_sha
+
+
+@metrics.timed_call
+def has_mention_comment(project_id, merge_request_id, comment, ctx=None):
+    merge_request = get_merge_request(project_id, merge_request_id, ctx)
+    _count(ctx, 'notes.list')
     notes = merge_request.notes.list(all=True)
     discussions = [n.attributes[u'body'] for n in notes]
     return comment in discussions
 
 
-def get_project_file(project_id, branch, path):
-    project = get_project(project_id)
+@metrics.timed_call
+def get_project_file(project_id, branch, path, ctx=None):
+    project = get_project(project_id, ctx)
+    _count(ctx, 'files.get')
     f = project.files.get(file_path=path, ref=branch)
     content = base64.b64decode(f.attributes[u'content'])
     return content
 
 
+@metrics.timed_call
+def get_project_file_blob_id(project_id, branch, path, ctx=None):
+    '''
+    Blob sha of `path` on `branch` from a HEAD request, so callers can tell
+    whether the file changed without downloading it. None if it is missing.
+    '''
+    client = get_gitlab_client()
+    _count(ctx, 'files.head')
+    try:
+        response = client.http_request(
+            'head',
+            '/projects/%s/repository/files/%s' % (project_id,
+                                                  quote(path, safe='')),
+            query_data={'ref': branch})
+    except GitlabHttpError as e:
+        if e.response_code == 404:
+            return None
+        raise
+    return response.headers.get('X-Gitlab-Blob-Id')
+
+
 def _search_authenticity_token(html):
     matched = re.search(
         r'<input type="hidden" name="authenticity_token" value="(.*)" />',
@@ -181,6 +358,7 @@ def _search_authenticity_token(html):
     return matched.group(1)
 
 
+@metrics.timed_call
 def login():
     '''
     source: https://gist.github.com/gpocentek/bd4c3fbf8a6ce226ebddc4aad6b46c0a
@@ -193,9 +371,9 @@ def login():
         logger.info('session exists')
     else:
         logger.info('no session')
-    session = requests.Session()
+    new_session = transport.new_session()
 
-    sign_in_page = session.get(SIGN_IN_URL).content.decode('utf-8')
+    sign_in_page = new_session.get(SIGN_IN_URL).content.decode('utf-8')
     for l in sign_in_page.split('\n'):
         m = re.search('name="authenticity_token" value="([^"]+)"', l)
         if m:
@@ -215,27 +393,31 @@ def login():
     }
     # this is one thing that lad this is one thing that lad this is one thing that lad this is one thing that lad this is one thing that lad this is one thing that lad this is one thing that lad
 
-    r = session.post(LOGIN_URL, data=data)
+    r = new_session.post(LOGIN_URL, data=data)
     if r.status_code != 200:
         logger.info('Failed to log in with status: {}. content={}'.format(
             r.status_code, r.content))
     else:
         logger.info('LOGIN WORKED')
 
-    session.headers.update({'Private-Token': GITLAB_TOKEN})
+    new_session.headers.update({'Private-Token': GITLAB_TOKEN})
+    session = new_session
 
 
 def setup_cookie():
-    global session
-    if not session:
-        logger.info('cookies need a setup')
-        login()
-    else:
+    if session:
         logger.info('cookies not needed')
+        return
+    with _login_lock:
+        if not session:
+            logger.info('cookies need a setup')
+            login()
 
 
-def fetch_blame(namespace, target_branch, path):
+@metrics.timed_call
+def fetch_blame(namespace, target_branch, path, ctx=None):
     setup_cookie()
+    _count(ctx, 'blame')
     try:
         url = '%s/%s/blame/%s/%s' % (GITLAB_URL, namespace, target_branch,
                                      path)
@@ -246,3 +428,26 @@ def fetch_blame(namespace, target_branch, path):
     except requests.HTTPError:
         logger.warning("Fetch blame failed: {}".format(url))
     return response.text
+
+
+@metrics.timed_call
+def fetch_blame_stream(namespace, target_branch, path, chunk_size=64 * 1024,
+                       ctx=None):
+    '''
+    Same page as fetch_blame, yielded as decoded text chunks so it never
+    has to be held in memory as a whole.
+    '''
+    setup_cookie()
+    _count(ctx, 'blame')
+    url = '%s/%s/blame/%s/%s' % (GITLAB_URL, namespace, target_branch, path)
+    response = session.get(url, stream=True)
+    try:
+        logger.info(f'url={url}; response status={response.status_code}')
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+        for chunk in response.iter_content(chunk_size, decode_unicode=True):
+            yield chunk
+    except requests.HTTPError:
+        logger.warning("Fetch blame failed: {}".format(url))
+    finally:
+        response.close()
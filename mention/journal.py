@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from queue import Queue, Empty
+
+from mention import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    received REAL NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    claimed_at REAL
+)
+'''
+# columns added after the first release, for journals created before them
+_MIGRATIONS = [
+    ('claimed_by', 'ALTER TABLE events ADD COLUMN claimed_by TEXT'),
+    ('claimed_at', 'ALTER TABLE events ADD COLUMN claimed_at REAL'),
+]
+
+_MAX_BATCH = 500
+
+
+class Journal(object):
+    '''
+    Write-ahead log of webhook events in sqlite (WAL mode), so events that
+    were acknowledged to gitlab survive a restart. A single writer thread
+    commits whatever appends and acks are waiting in one transaction, so
+    concurrent webhooks share an fsync instead of paying one each.
+
+    Every event is claimed by the process holding it, which renews its
+    claims while it runs. Events stay in the log until they are acked after
+    being processed; `pending()` hands out those whose claim has lapsed for
+    `lease` seconds, i.e. whose process is gone, to exactly one process.
+    Delivery is at-least-once.
+    '''
+
+    def __init__(self, path, max_attempts, lease=60, max_age=0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.max_age = max_age
+        # pids are reused across container restarts, the start time isn't
+        self.owner = '{}:{:.6f}'.format(os.getpid(), time.time())
+        self._ops = Queue()
+        self._conn = None
+        self._writer = None
+        self._renewed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=FULL')
+            self._conn.execute(_SCHEMA)
+            columns = {row[1] for row in
+                       self._conn.execute('PRAGMA table_info(events)')}
+            for column, statement in _MIGRATIONS:
+                if column not in columns:
+                    self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
+
+    def _start_writer(self):
+        with self._lock:
+            self._connect()
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop)
+                self._writer.daemon = True
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            try:
+                ops = [self._ops.get(timeout=self.lease / 3)]
+            except Empty:
+                ops = []
+            while len(ops) < _MAX_BATCH and not self._ops.empty():
+                ops.append(self._ops.get_nowait())
+            try:
+                self._write(ops)
+            except Exception:
+                logger.exception('journal commit of {} ops failed'.format(
+                    len(ops)))
+            for op in ops:
+                if op['done'] is not None:
+                    op['done'].set()
+
+    def _write(self, ops):
+        now = time.time()
+        renew = now - self._renewed >= self.lease / 3
+        if not ops and not renew:
+            return
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for op in ops:
+                    if op['kind'] == 'append':
+                        op['id'] = conn.execute(
+                            'INSERT INTO events (received, payload, '
+                            'claimed_by, claimed_at) VALUES (?, ?, ?, ?)',
+                            (op['received'], op['payload'], self.owner,
+                             now)).lastrowid
+                    elif op['kind'] == 'start':
+                        conn.executemany(
+                            'UPDATE events SET attempts = attempts + 1 '
+                            'WHERE id=?', [(i, ) for i in op['ids']])
+                    else:
+                        conn.executemany('DELETE FROM events WHERE id=?',
+                                         [(i, ) for i in op['ids']])
+                if renew:
+                    # keeps other processes from replaying what we still hold
+                    conn.execute(
+                        'UPDATE events SET claimed_at=? WHERE claimed_by=?',
+                        (now, self.owner))
+                    self._renewed = now
+
+    def append(self, payload, timeout=5):
+        '''
+        Returns the id of the event once it is committed, or None if the
+        commit didn't happen within `timeout` seconds.
+        '''
+        self._start_writer()
+        op = {
+            'kind': 'append',
+            'received': time.time(),
+            'payload': json.dumps(payload),
+            'id': None,
+            'done': threading.Event(),
+        }
+        self._ops.put(op)
+        op['done'].wait(timeout)
+        return op['id']
+
+    def start(self, ids, timeout=5):
+        '''
+        Counts a processing attempt of the events, before it begins, so an
+        event that keeps crashing the process is eventually dropped.
+        '''
+        ids = [i for i in ids if i is not None]
+        if ids:
+            self._start_writer()
+            op = {'kind': 'start', 'ids': ids, 'done': threading.Event()}
+            self._ops.put(op)
+            op['done'].wait(timeout)
+
+    def ack(self, ids):
+        ids = [i for i in ids if i is not None]
+        if ids:
+            self._start_writer()
+            self._ops.put({'kind': 'ack', 'ids': ids, 'done': None})
+
+    def pending(self):
+        '''
+        Claims the events no running process holds, oldest first, and
+        returns them as (id, received, payload). Of those, events that
+        already had `max_attempts` processing attempts, or were received
+        more than `max_age` seconds ago (if set), are dropped instead.
+        '''
+        # renewing our claims needs the writer thread
+        self._start_writer()
+        now = time.time()
+        lapsed = 'claimed_by IS NULL OR claimed_at < ?'
+        with self._lock:
+            conn = self._connect()
+            # take the write lock first, so two processes can't both claim
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                dropped = conn.execute(
+                    'DELETE FROM events WHERE ({}) AND attempts >= ?'.format(
+                        lapsed),
+                    (now - self.lease, self.max_attempts)).rowcount
+                expired = 0
+                if self.max_age:
+                    expired = conn.execute(
+                        'DELETE FROM events WHERE ({}) AND received < ?'.format(
+                            lapsed),
+                        (now - self.lease, now - self.max_age)).rowcount
+                rows = conn.execute(
+                    'SELECT id, received, payload FROM events WHERE {} '
+                    'ORDER BY id'.format(lapsed),
+                    (now - self.lease, )).fetchall()
+                conn.executemany(
+                    'UPDATE events SET claimed_by=?, claimed_at=? WHERE id=?',
+                    [(self.owner, now, i) for i, _, _ in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if dropped:
+            logger.warning('journal dropped {} events after {} attempts'.format(
+                dropped, self.max_attempts))
+        if expired:
+            logger.warning(
+                'journal dropped {} events older than {}s'.format(
+                    expired, self.max_age))
+        return [(i, received, json.loads(payload))
+                for i, received, payload in rows]
+
+
+journal = Journal(config.QUEUE_JOURNAL_PATH, config.QUEUE_JOURNAL_MAX_ATTEMPTS,
+                  config.QUEUE_JOURNAL_LEASE, config.QUEUE_JOURNAL_MAX_AGE)
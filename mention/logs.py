@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import random
+import logging
+import logging.config
+
+# pass as `extra` to mark a record as verbose, i.e. subject to LOG_SAMPLE_RATE
+VERBOSE = {'verbose': True}
+
+_RECORD_ATTRS = set(
+    logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {
+        'message', 'asctime', 'verbose', 'sampled'
+    }
+
+
+class Lazy(object):
+    '''
+    Log argument that is only computed if a handler formats the record, and
+    then only once: every handler (and RotatingFileHandler's rollover check)
+    formats the record again.
+    '''
+    __slots__ = ('fn', 'args', 'value')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+        self.value = None
+
+    def __str__(self):
+        if self.value is None:
+            self.value = str(self.fn(*self.args))
+        return self.value
+
+
+def lazy(fn, *args):
+    return Lazy(fn, *args)
+
+
+def truncate(value, limit):
+    if limit and len(value) > limit:
+        return '{}...<{} more chars>'.format(value[:limit],
+                                             len(value) - limit)
+    return value
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Lets through a `rate` fraction of the records marked VERBOSE, and every
+    other record. The draw is kept on the record, so every handler keeps
+    the same records.
+    '''
+
+    def __init__(self, rate=1.0):
+        super(SampleFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or not getattr(record, 'verbose', False):
+            return True
+        sampled = getattr(record, 'sampled', None)
+        if sampled is None:
+            sampled = record.sampled = random.random() < self.rate
+        return sampled
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per record. The message, traceback and any `extra`
+    fields are cut to `max_field` characters.
+    '''
+
+    def __init__(self, max_field=0):
+        super(JsonFormatter, self).__init__()
+        self.max_field = max_field
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'loc': '{}:{}'.format(record.filename, record.lineno),
+            'thread': record.threadName,
+            'msg': truncate(record.getMessage(), self.max_field),
+        }
+        if record.exc_info:
+            entry['exc'] = truncate(self.formatException(record.exc_info),
+                                    self.max_field)
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                if not isinstance(value, (int, float, bool, type(None))):
+                    value = truncate(str(value), self.max_field)
+                entry[key] = value
+        return json.dumps(entry)
+
+
+def setup(log_format, filename, max_field=0, sample_rate=1.0):
+    '''
+    Configures the root logger to write `log_format` ('text' or 'json')
+    records to the console and to a rotating `filename`.
+    '''
+    if log_format not in ('text', 'json'):
+        raise ValueError('unknown log format: {}'.format(log_format))
+    formatters = {
+        'text': {
+            'format':
+            '%(levelname)s %(asctime)s %(filename)s:%(lineno)d '
+            '%(message)s'
+        },
+        'json': {
+            '()': JsonFormatter,
+            'max_field': max_field,
+        },
+    }
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            log_format: formatters[log_format]
+        },
+        'filters': {
+            'sample': {
+                '()': SampleFilter,
+                'rate': sample_rate,
+            },
+        },
+        'handlers': {
+            'console': {
+                'level': 'DEBUG',
+                'class': 'logging.StreamHandler',
+                'formatter': log_format,
+                'filters': ['sample'],
+            },
+            'file': {
+                'class': 'logging.handlers.RotatingFileHandler',
+                'formatter': log_format,
+                'filters': ['sample'],
+                'filename': filename,
+                'maxBytes': 100 * 1024 * 1024,
+                'backupCount': 30
+            }
+        },
+        'root': {
+            'level': 'INFO',
+            'handlers': ['console', 'file']
+        }
+    })
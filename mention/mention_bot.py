@@ -2,22 +2,40 @@
 # coding: utf-8
 import re
 import json
+import time
+import heapq
 import logging
 import datetime
-from collections import defaultdict
-from fnmatch import fnmatch
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
+from functools import lru_cache
 
 from mention import notify
 from mention import config
 from mention import gitlab_client
 from mention import helper
+from mention import user_directory
+from mention import blame_cache
+from mention import git_mirror
+from mention import ownership_index
+from mention import ownership_score
+from mention import logs
+from mention import metrics
 
 logger = logging.getLogger(__name__)
 
 RE_DIFF_LINE_NO = re.compile(r'\@\@ -(\d+),?(\d+)? \+(\d+),?(\d+)? \@\@')
 RE_BLAME_OR_NO = re.compile(
-    r'(<a class=.commit-author-link.*href=.\/([\w.\d]+)|<a class=.diff-line-num.)'
-)
+    r'(<a class=.commit-author-link.*href=.\/([\w.\d]+)'
+    r'|<a class=.commit-sha. href=.[^"\']*/commit/([0-9a-f]+)'
+    r'|<time [^>]*datetime=.([^"\']+)'
+    r'|<a class=.diff-line-num.)')
+
+# shared by every merge request so a burst of MRs can't flood gitlab with
+# blame page renders
+_blame_semaphore = threading.BoundedSemaphore(config.BLAME_MAX_CONCURRENCY)
 
 
 class BotConfig(object):
@@ -32,77 +50,97 @@ class BotConfig(object):
         return cfg
 
 
-def parse_diff_file(lines):
+def get_deleted_lines(diff):
+    '''
+    The old-file line number of every removed line of a file diff.
+    '''
     deleted_lines = []
     current_from_line = 0
-    lines = list(lines)
-    while len(lines) > 0:
-        line = lines.pop()
-        if line.startswith('---') or line.startswith('+++'):
+    for line in diff.split('\n'):
+        # added lines (and the +++ header) don't exist in the old file
+        first = line[:1]
+        if first == '+':
             continue
-        if line.startswith('@@'):
-            matched = RE_DIFF_LINE_NO.match(line)
-            if matched is None:
+        if first == '-':
+            if line.startswith('---'):
                 continue
-            from_line = matched.group(1)
-            # from_count = matched.group(2)
-            # to_line = matched.group(3)
-            # to_count = matched.group(4)
-            current_from_line = int(from_line)
-            continue
-        if line.startswith('-'):
             deleted_lines.append(current_from_line)
-        if not line.startswith('+'):
-            current_from_line += 1
+        elif first == '@' and line.startswith('@@'):
+            matched = RE_DIFF_LINE_NO.match(line)
+            if matched is not None:
+                current_from_line = int(matched.group(1))
+            continue
+        current_from_line += 1
     return deleted_lines
 
 
-def parse_diff(changes):
-    files = []
+def iter_diff_files(changes):
+    '''
+    Yield (old_path, [deleted line no]) for each file diff in `changes`.
+    '''
     for diff in changes:
-        from_file = diff['old_path']
-        lines = diff['diff'].split('\n')
-        deleted_lines = parse_diff_file(reversed(lines))
-        files.append((from_file, deleted_lines))
-    return files
+        yield diff['old_path'], get_deleted_lines(diff['diff'])
+
+
+def parse_diff(changes):
+    return list(iter_diff_files(changes))
+
+
+def iter_blame_lines(chunks):
+    '''
+    Yield (author, commit sha, committed_at) for every line of a blame page
+    given as text chunks, `committed_at` being epoch seconds. Matches never
+    span a newline, so only the unfinished last line of the chunks seen so
+    far has to be held in memory.
+    '''
+    current = ['none', None, None]
+
+    def lines_of(text):
+        for matches in RE_BLAME_OR_NO.finditer(text):
+            if matches.group(2):
+                current[0] = matches.group(2)
+            elif matches.group(3):
+                current[1] = matches.group(3)
+            elif matches.group(4):
+                current[2] = ownership_score.parse_timestamp(matches.group(4))
+            else:
+                yield tuple(current)
+
+    pending = []
+    for chunk in chunks:
+        cut = chunk.rfind('\n')
+        if cut < 0:
+            pending.append(chunk)
+            continue
+        text = ''.join(pending) + chunk[:cut]
+        pending = [chunk[cut + 1:]]
+        yield from lines_of(text)
+    yield from lines_of(''.join(pending))
+
+
+def iter_blame_authors(chunks):
+    return (author for author, _, _ in iter_blame_lines(chunks))
 
 
 def parse_blame(blame):
-    lines = []
-    current_author = 'none'
-    result = RE_BLAME_OR_NO.finditer(blame) if blame else ''
+    return list(iter_blame_authors([blame])) if blame else []
 
-    for matches in result:
-        if matches.group(2):
-            current_author = matches.group(2)
-        else:
-            lines.append(current_author)
-    return lines
+
+def parse_blame_stream(chunks):
+    return list(iter_blame_authors(chunks))
+
+
+def parse_dated_blame(chunks):
+    return [[author, committed_at]
+            for author, _, committed_at in iter_blame_lines(chunks)]
 
 
 def get_deleted_owners(files, blames):
-    owners = defaultdict(int)
-    for file_path, deleted_lines in files:
-        blame = blames.get(file_path)
-        if not blame:
-            continue
-        for line in deleted_lines:
-            author_name = blame[line - 1]
-            if not author_name:
-                continue
-            owners[author_name] += 1
-    return owners
+    return ownership_score.score_owners(files, blames).deleted_owners()
 
 
 def get_all_owners(files, blames):
-    owners = defaultdict(int)
-    for file_path, deleted_lines in files:
-        blame = blames.get(file_path, None)
-        if blame is None:
-            continue
-        for author_name in blame:
-            owners[author_name] += 1
-    return owners
+    return ownership_score.score_owners(files, blames).all_owners()
 
 
 def sort_owners(owners):
@@ -110,78 +148,181 @@ def sort_owners(owners):
     return sorted(owner_names, key=lambda k: owners[k], reverse=True)
 
 
-def guess_owners(files, blames, creator, cfg):
+def guess_owners(files, blames, creator, cfg, ctx=None):
     if files:
-        deleted_owners = get_deleted_owners(files, blames)
-        all_owners = get_all_owners(files, blames)
-
-        deleted_owners = sort_owners(deleted_owners)
-        all_owners = sort_owners(all_owners)
-
-        deleted_owners_set = set(deleted_owners)
-        other_owners = [
-            owner for owner in all_owners if owner not in deleted_owners_set
-        ]
-
-        owners = deleted_owners + other_owners
-        active_users = gitlab_client.get_active_users()
+        started = time.monotonic()
+        scores = ownership_score.score_owners(files, blames,
+                                              cfg.ownershipHalfLifeDays)
+        owners = scores.ranked()
 
         def filter_owners(owner):
             return all([
                 owner != creator, owner != 'none',
-                owner not in cfg.userBlacklist, owner in active_users
+                owner not in cfg.userBlacklist
             ])
 
-        logger.info('guess_owners: locals={}'.format(locals()))
-        return [u for u in owners if filter_owners(u)][:cfg.maxReviewers]
+        # check activity last and stop once we have enough reviewers, so a
+        # cold user directory only looks up the few candidates we need
+        reviewers = []
+        # ranking is lazy and interleaved with the lookups, so their time
+        # is taken out of the scoring stage
+        users_seconds = 0
+        for owner in filter(filter_owners, owners):
+            if len(reviewers) >= cfg.maxReviewers:
+                break
+            looked_up = time.monotonic()
+            active = user_directory.is_active(owner, ctx)
+            users_seconds += time.monotonic() - looked_up
+            if active:
+                reviewers.append(owner)
+        metrics.stage_seconds.observe(
+            time.monotonic() - started - users_seconds, stage='score')
+        metrics.stage_seconds.observe(users_seconds, stage='users')
+
+        # the blames themselves are already logged as verbose records
+        logger.info(
+            'guess_owners: creator=%s; files=%s; blamed_lines=%s; '
+            'reviewers=%s', creator, [(f, len(lines)) for f, lines in files],
+            sum(len(blames.get(f) or []) for f, _ in files), reviewers)
+        return reviewers
     return []
 
 
-def filter_files(files, fileBlacklist, numFilesToCheck):
-    def filter_file_black_list(files):
-        new_files = []
-        for filename, lines in files:
-            flag = False
-            for pattern in fileBlacklist:
-                if fnmatch(filename, pattern):
-                    flag = True
-            if not flag:
-                new_files.append((filename, lines))
-        return new_files
-
-    files = sorted(files, key=lambda f: len(f[1]), reverse=True)
-    if len(fileBlacklist) > 0:
-        files = filter_file_black_list(files)
-    return files[:numFilesToCheck]
+@lru_cache(maxsize=128)
+def _compile_file_blacklist(patterns):
+    return re.compile('|'.join(translate(p) for p in patterns))
 
 
-def get_files_blames(repo_namespace, target_branch, files):
-    blames = {}
-    for from_file, linenos in files:
-        blame = gitlab_client.fetch_blame(repo_namespace, target_branch,
-                                          from_file)
-        logger.info('file={}; lines={}'.format(from_file, linenos))
-        logger.info('blame.len={}; blame = {}'.format(
-            len(blame),
-            blame.encode('ascii', 'ignore').decode('ascii')))
-        parsed_blame = parse_blame(blame)
-        blames[from_file] = parsed_blame
-        logger.info('file: {}; parsed_blame={}'.format(from_file,
-                                                       parsed_blame))
-    return blames
-
-
-def _set_labels(labels, project_id, merge_request_id):
+def filter_files(files, fileBlacklist, numFilesToCheck):
+    """
+    The `numFilesToCheck` files with the most deleted lines that don't match
+    any fileBlacklist glob. Ties keep their order in `files`.
+    """
+    if len(fileBlacklist) > 0:
+        blacklisted = _compile_file_blacklist(tuple(fileBlacklist)).match
+        files = (f for f in files if not blacklisted(f[0]))
+    return heapq.nlargest(numFilesToCheck, files, key=lambda f: len(f[1]))
+
+
+def _ascii(text):
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+def _get_file_blame(repo_namespace, ref, from_file, linenos, cacheable,
+                    dated=False, ctx=None):
+    """
+    Author per line of `from_file`, or [author, committed_at] pairs if
+    `dated`. Dated blames are what gets cached, either shape can be served
+    from it.
+    """
+    if cacheable:
+        parsed_blame = blame_cache.cache.get(repo_namespace, ref, from_file)
+        if parsed_blame is not None:
+            logger.info('file={}; blame cache hit at {}'.format(from_file, ref))
+            if not dated:
+                return ownership_score.authors_only(parsed_blame)
+            return parsed_blame
+    logger.info('file={}; lines={}'.format(from_file, linenos))
+    with _blame_semaphore:
+        if config.BLAME_STREAMING:
+            parsed_blame = parse_dated_blame(
+                gitlab_client.fetch_blame_stream(repo_namespace, ref,
+                                                 from_file, ctx=ctx))
+        else:
+            blame = gitlab_client.fetch_blame(repo_namespace, ref, from_file,
+                                              ctx=ctx)
+            logger.info('blame.len=%s; blame = %s', len(blame),
+                        logs.lazy(_ascii, blame), extra=logs.VERBOSE)
+            parsed_blame = parse_dated_blame([blame] if blame else [])
+    logger.info('file: %s; parsed_blame=%s', from_file, parsed_blame,
+                extra=logs.VERBOSE)
+    # an empty result may just be a failed fetch, don't pin it to the commit
+    if cacheable and parsed_blame:
+        blame_cache.cache.put(repo_namespace, ref, from_file, parsed_blame)
+    if not dated:
+        return ownership_score.authors_only(parsed_blame)
+    return parsed_blame
+
+
+def _resolve_blame_ref(repo_namespace, target_branch, ctx=None):
+    """
+    Blame at the branch head sha, so results can be cached. Falls back to
+    the branch name (uncached) if the branch can't be resolved.
+    """
+    try:
+        return gitlab_client.get_branch_head(repo_namespace, target_branch,
+                                             ctx), True
+    except Exception:
+        logger.exception('Unable to resolve {} of {}'.format(
+            target_branch, repo_namespace))
+        return target_branch, False
+
+
+def _get_mirror_blames(repo_namespace, ref, resolved, files, dated=False):
+    git_mirror.ensure_mirror(repo_namespace, ref if resolved else None)
+    return {
+        from_file: git_mirror.blame(repo_namespace, ref, from_file,
+                                    dated=dated)
+        for from_file, linenos in files
+    }
+
+
+def get_files_blames(repo_namespace, target_branch, files, concurrency=1,
+                     backend='html', commit_sha=None, dated=False, ctx=None):
+    """
+    Fetch and parse the blame of every file, `concurrency` files at a time.
+    Returns {path: [author per line]} in the same order as `files`, or
+    [author, committed_at] per line if `dated`.
+    Pass `commit_sha` if the head of `target_branch` is already known.
+    """
+    ref, resolved = target_branch, False
+    if commit_sha:
+        ref, resolved = commit_sha, True
+    elif backend == 'mirror' or blame_cache.cache.enabled:
+        ref, resolved = _resolve_blame_ref(repo_namespace, target_branch,
+                                           ctx)
+
+    if backend == 'mirror':
+        try:
+            return _get_mirror_blames(repo_namespace, ref, resolved, files,
+                                      dated)
+        except (subprocess.SubprocessError, OSError) as e:
+            # a clone or fetch that fails or times out must not cost the MR
+            # its comment and labels, blame through gitlab instead
+            logger.warning('mirror of {} unavailable, using html blame: '
+                           '{}'.format(repo_namespace, e))
+
+    cacheable = resolved and blame_cache.cache.enabled
+    if concurrency <= 1 or len(files) <= 1:
+        return {
+            from_file: _get_file_blame(repo_namespace, ref, from_file,
+                                       linenos, cacheable, dated, ctx)
+            for from_file, linenos in files
+        }
+
+    # login once up front instead of racing in every worker thread
+    gitlab_client.setup_cookie()
+    with ThreadPoolExecutor(max_workers=min(concurrency,
+                                            len(files))) as executor:
+        futures = [(from_file,
+                    executor.submit(_get_file_blame, repo_namespace, ref,
+                                    from_file, linenos, cacheable, dated,
+                                    ctx))
+                   for from_file, linenos in files]
+        return {from_file: future.result() for from_file, future in futures}
+
+
+def _set_labels(labels, project_id, merge_request_id, ctx=None):
     logger.info(f'Setting labels={labels}')
     labels_in_str = ','.join(labels)
     if labels_in_str:
-        gitlab_client.update_labels(project_id, merge_request_id, labels)
+        gitlab_client.update_labels(project_id, merge_request_id, labels, ctx)
     logger.info('labels updated on gitlab MR')
 
 
 def _manage_labels(project_id, merge_request_id, cfg, labels, username, action,
-                   iid, url, title):
-    _set_labels(labels, project_id, merge_request_id)
+                   iid, url, title, ctx=None):
+    _set_labels(labels, project_id, merge_request_id, ctx)
 
     channels = gitlab_client.get_channels_based_on_labels(cfg, labels)
     logger.info('channels={}'.format(channels))
@@ -190,20 +331,33 @@ def _manage_labels(project_id, merge_request_id, cfg, labels, username, action,
                                            title)
 
     logger.info('slack msg={}'.format(msg))
-    notify.send_to_slack(text, msg, channels)
-    logger.info('msg sent to slack on channels: {}'.format(channels))
-
-
-def get_diff_files(project_id, merge_request_id):
+    if cfg.slackDigestWindow and action not in cfg.slackDigestBypassActions:
+        notify.digest_slack(text, channels, cfg.slackDigestWindow)
+        logger.info('msg added to slack digest of channels: {}'.format(
+            channels))
+    else:
+        notify.enqueue_slack(text, msg, channels)
+        logger.info('msg queued for slack on channels: {}'.format(channels))
+
+
+def get_diff_files(project_id, merge_request_id, ctx=None):
+    if config.DIFF_STREAMING:
+        files = parse_diff(
+            gitlab_client.iter_merge_request_diff(project_id,
+                                                  merge_request_id, ctx))
+        if not files:
+            logger.info('No files found.')
+        return files
     changes = gitlab_client.get_merge_request_diff(project_id,
-                                                   merge_request_id)
+                                                   merge_request_id, ctx)
     files = parse_diff(changes)
     if not files:
         logger.info('No files found. Changes were: {}'.format(changes))
     return files
 
 
-def manage_labels(payload, project_id, merge_request_id, cfg, diff_files):
+def manage_labels(payload, project_id, merge_request_id, cfg, diff_files,
+                  ctx=None):
     labels = gitlab_client.get_labels(
         cfg, diff_files) or gitlab_client.get_payload_labels(payload)
     username = payload['user']['username']
@@ -215,20 +369,60 @@ def manage_labels(payload, project_id, merge_request_id, cfg, diff_files):
     title = obj['title']
 
     _manage_labels(project_id, merge_request_id, cfg, labels, username, action,
-                   iid, url, title)
+                   iid, url, title, ctx)
+
+
+def get_indexed_blames(project_id, namespace, target_branch, files, cfg,
+                       ctx=None):
+    """
+    Same as get_files_blames, but answers from the push-fed ownership index
+    when it is current for the branch head and only blames the misses.
+    """
+    dated = bool(cfg.ownershipHalfLifeDays)
+    head, resolved = _resolve_blame_ref(namespace, target_branch, ctx)
+    if not resolved:
+        return get_files_blames(namespace, target_branch, files,
+                                cfg.blameConcurrency, cfg.blameBackend,
+                                dated=dated, ctx=ctx)
+
+    indexed = {}
+    misses = []
+    for from_file, linenos in files:
+        authors = ownership_index.index.get(project_id, target_branch, head,
+                                            from_file)
+        if authors is None:
+            misses.append((from_file, linenos))
+        else:
+            indexed[from_file] = authors
+    logger.info('ownership index: hits={}; misses={}'.format(
+        len(indexed), len(misses)))
+
+    fetched = get_files_blames(namespace, target_branch, misses,
+                               cfg.blameConcurrency, cfg.blameBackend, head,
+                               dated, ctx)
+    for from_file, authors in fetched.items():
+        if authors:
+            ownership_index.index.seed(project_id, target_branch, head,
+                                       from_file, authors)
+    indexed.update(fetched)
+    return {from_file: indexed[from_file] for from_file, _ in files}
 
 
 # IMP function
 def guess_owners_for_merge_reqeust(project_id, namespace, target_branch,
-                                   merge_request_id, creator, cfg, diff_files):
+                                   merge_request_id, creator, cfg, diff_files,
+                                   ctx=None):
     if not cfg.findPotentialReviewers:
         return []
     files = filter_files(diff_files, cfg.fileBlacklist, cfg.numFilesToCheck)
-    blames = get_files_blames(namespace, target_branch, files)
-    return guess_owners(files, blames, creator, cfg)
+    with metrics.stage('blame'):
+        blames = get_indexed_blames(project_id, namespace, target_branch,
+                                    files, cfg, ctx)
+    return guess_owners(files, blames, creator, cfg, ctx)
 
 
-def add_comment(project_id, merge_request_id, creator, reviewers, cfg):
+def add_comment(project_id, merge_request_id, creator, reviewers, cfg,
+                ctx=None):
     if not cfg.createComment:
         return
     msg = """{0}, thanks for your MR!
@@ -240,15 +434,16 @@ def add_comment(project_id, merge_request_id, creator, reviewers, cfg):
         return False
     note = msg.format(creator, ' and '.join(reviewers_mentions))
     if cfg.skipAlreadyMentionedMR and\
-       gitlab_client.has_mention_comment(project_id, merge_request_id, note):
+       gitlab_client.has_mention_comment(project_id, merge_request_id, note,
+                                         ctx):
         return False
     return gitlab_client.add_comment_merge_request(project_id,
-                                                   merge_request_id, note)
+                                                   merge_request_id, note, ctx)
 
 
-def get_repo_config(project_id, target_branch, config_path):
+def get_repo_config(project_id, target_branch, config_path, ctx=None):
     filecontent = gitlab_client.get_project_file(project_id, target_branch,
-                                                 config_path)
+                                                 config_path, ctx)
     if not filecontent:
         logger.warning(
             "Unable to find config file, use default config instead.")
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import bisect
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, float('inf'))
+WAIT_BUCKETS = (1, 5, 10, 15, 30, 60, 120, 300, 600, 1800, float('inf'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + '}'
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}, got {}'.format(
+                self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _collect(self):
+        if self.fn is None:
+            with self._lock:
+                return sorted(self._values.items())
+        values = self.fn()
+        if not isinstance(values, dict):
+            return [((), values)]
+        return sorted(values.items())
+
+    def samples(self):
+        for key, value in self._collect():
+            yield self.name + _format_labels(self.labelnames,
+                                             key), _format_value(value)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1], entry[2]))
+                            for key, entry in self._values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for le, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + '_bucket' + _format_labels(
+                    self.labelnames, key,
+                    [('le', _format_value(le))]), str(cumulative)
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + '_sum' + labels, _format_value(total)
+            yield self.name + '_count' + labels, str(count)
+
+
+class Registry(object):
+    '''
+    In-process metrics, rendered in the Prometheus text format. Counters and
+    gauges given a `fn` read their value(s) from it at render time: a number,
+    or a dict of {label values tuple: number}.
+    '''
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Counter(name, documentation, labelnames, fn))
+
+    def gauge(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._add(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name,
+                                               metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend('{} {}'.format(name, value)
+                         for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'mention_stage_seconds', 'Time spent in each stage of handling an event',
+    ['stage'])
+gitlab_call_seconds = registry.histogram(
+    'mention_gitlab_call_seconds', 'Duration of gitlab_client calls',
+    ['function'])
+gitlab_call_errors = registry.counter('mention_gitlab_call_errors_total',
+                                      'gitlab_client calls that raised',
+                                      ['function'])
+events_total = registry.counter('mention_events_total',
+                                'Events handled by the payload workers',
+                                ['kind', 'outcome'])
+event_wait_seconds = registry.histogram(
+    'mention_event_wait_seconds',
+    'Time from receiving an event to a payload worker picking it up',
+    ['kind'], WAIT_BUCKETS)
+
+
+def stage(name):
+    return stage_seconds.time(stage=name)
+
+
+def timed_call(fn):
+    '''
+    Records the duration (and exceptions) of a gitlab_client function.
+    Generators are timed until they are exhausted.
+    '''
+    name = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                yield from fn(*args, **kwargs)
+            except Exception:
+                gitlab_call_errors.inc(function=name)
+                raise
+            finally:
+                gitlab_call_seconds.observe(time.monotonic() - started,
+                                            function=name)
+
+        return wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            gitlab_call_errors.inc(function=name)
+            raise
+        finally:
+            gitlab_call_seconds.observe(time.monotonic() - started,
+                                        function=name)
+
+    return wrapper
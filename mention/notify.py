@@ -1,21 +1,244 @@
 import sys
 import json
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from slacker import Slacker
 
+from mention import config
+from mention import transport
+from mention import metrics
 from mention.config import SLACK_TOKEN
+from mention.scheduler import DelayScheduler
 
 logger = logging.getLogger(__name__)
 
+_slack = None
+_SLACKER_API_URL = 'https://slack.com/api/'
 
-def send_to_slack(text, msg, channels):
-    slack = Slacker(SLACK_TOKEN)
-    for channel in channels:
-        slack.chat.post_message(channel,
-                                text=text,
-                                attachments=msg,
-                                as_user=False)
+
+def _rebase(session, base_url):
+    # slacker has the api url hard-coded, so rewrite it on the way out
+    request = session.request
+
+    def rebased(method, url, *args, **kwargs):
+        if url.startswith(_SLACKER_API_URL):
+            url = base_url.rstrip('/') + '/' + url[len(_SLACKER_API_URL):]
+        return request(method, url, *args, **kwargs)
+
+    session.request = rebased
+    return session
+
+
+def get_slack_client():
+    # one client, and so one pooled session, for every message we send
+    global _slack
+    if _slack is None:
+        session = transport.new_session()
+        if config.SLACK_API_URL != _SLACKER_API_URL:
+            _rebase(session, config.SLACK_API_URL)
+        _slack = Slacker(SLACK_TOKEN,
+                         timeout=config.HTTP_READ_TIMEOUT,
+                         session=session)
+    return _slack
+
+
+class SlackOutbox(object):
+    '''
+    Delivers slack messages on its own threads so the payload workers never
+    wait for slack. A channel that answers 429 is left alone until its
+    Retry-After has passed; its messages are rescheduled, not dropped,
+    unless they fail `max_attempts` times.
+    '''
+
+    def __init__(self, workers, max_attempts):
+        self.max_attempts = max_attempts
+        self.delivered = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self._workers = workers
+        self._executor = None
+        self._scheduler = DelayScheduler(self._dispatch)
+        self._channel_free_at = {}
+        # guards the counters and _channel_free_at across delivery threads
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def _start(self):
+        with self._cond:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers)
+                self._scheduler.start()
+
+    def enqueue(self, text, msg, channels):
+        self._start()
+        now = time.monotonic()
+        for channel in channels:
+            with self._cond:
+                self._pending += 1
+            with self._lock:
+                free_at = self._channel_free_at.get(channel, 0)
+            self._scheduler.schedule(
+                max(now, free_at), {
+                    'channel': channel,
+                    'text': text,
+                    'msg': msg,
+                    'enqueued': now,
+                    'attempts': 0,
+                })
+
+    def _dispatch(self, item):
+        self._executor.submit(self._deliver, item)
+
+    def _done(self):
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def _deliver(self, item):
+        channel = item['channel']
+        with self._lock:
+            free_at = self._channel_free_at.get(channel, 0)
+        if free_at > time.monotonic():
+            self._scheduler.schedule(free_at, item)
+            return
+        item['attempts'] += 1
+        started = time.monotonic()
+        try:
+            with metrics.stage('slack'):
+                get_slack_client().chat.post_message(channel,
+                                                     text=item['text'],
+                                                     attachments=item['msg'],
+                                                     as_user=False)
+        except Exception as e:
+            retry_after = None
+            if isinstance(e, requests.HTTPError) and \
+               e.response is not None and e.response.status_code == 429:
+                retry_after = float(e.response.headers.get('Retry-After', 1))
+                with self._lock:
+                    self.rate_limited += 1
+                    self._channel_free_at[channel] = max(
+                        self._channel_free_at.get(channel, 0),
+                        time.monotonic() + retry_after)
+            if item['attempts'] < self.max_attempts:
+                logger.warning('slack post to {} failed ({}), retrying'.format(
+                    channel, e))
+                self._scheduler.schedule(
+                    time.monotonic() + (retry_after or 2**item['attempts']),
+                    item)
+                return
+            with self._lock:
+                self.failed += 1
+            logger.exception('slack post to {} dropped after {} attempts'.format(
+                channel, item['attempts']))
+            self._done()
+            return
+        with self._lock:
+            self.delivered += 1
+        finished = time.monotonic()
+        logger.info('slack msg sent to {}: post={:.3f}s; queued={:.3f}s'.format(
+            channel, finished - started, started - item['enqueued']))
+        self._done()
+
+    def join(self, timeout=None):
+        '''
+        Waits until every enqueued message is delivered or dropped.
+        '''
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            while self._pending:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+outbox = SlackOutbox(config.SLACK_WORKERS, config.SLACK_MAX_ATTEMPTS)
+metrics.registry.counter(
+    'mention_slack_messages_total',
+    'Slack messages delivered or dropped, and posts answered with a 429',
+    ['outcome'], lambda: {
+        ('delivered', ): outbox.delivered,
+        ('failed', ): outbox.failed,
+        ('rate_limited', ): outbox.rate_limited,
+    })
+metrics.registry.gauge('mention_slack_pending',
+                       'Slack messages not yet delivered or dropped',
+                       fn=lambda: outbox._pending)
+
+
+def enqueue_slack(text, msg, channels):
+    outbox.enqueue(text, msg, channels)
+
+
+_DIGEST_MAX_LINES = 50
+
+
+class SlackDigest(object):
+    '''
+    Collects message lines per channel and hands them to the outbox as one
+    message once the window that started with the first line is over, or
+    once _DIGEST_MAX_LINES lines are waiting.
+    '''
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self._lines = {}
+        self._lock = threading.Lock()
+        self._scheduler = DelayScheduler(self._window_over)
+        self._started = False
+
+    def add(self, text, channels, window):
+        with self._lock:
+            if not self._started:
+                self._scheduler.start()
+                self._started = True
+            full = []
+            for channel in channels:
+                if channel not in self._lines:
+                    self._lines[channel] = []
+                    self._scheduler.schedule(time.monotonic() + window,
+                                             (channel, self._lines[channel]))
+                self._lines[channel].append(text)
+                if len(self._lines[channel]) >= _DIGEST_MAX_LINES:
+                    full.append(channel)
+        for channel in full:
+            self.flush(channel)
+
+    def _window_over(self, item):
+        channel, lines = item
+        # the lines this window started with may already have been sent
+        if self._lines.get(channel) is lines:
+            self.flush(channel)
+
+    def flush(self, channel):
+        with self._lock:
+            lines = self._lines.pop(channel, None)
+        if lines:
+            self.outbox.enqueue(format_digest(lines), None, [channel])
+
+    def flush_all(self):
+        for channel in list(self._lines):
+            self.flush(channel)
+
+
+def format_digest(lines):
+    if len(lines) == 1:
+        return lines[0]
+    return '\n'.join(['*{} merge request updates*'.format(len(lines))] +
+                     lines)
+
+
+digest = SlackDigest(outbox)
+
+
+def digest_slack(text, channels, window):
+    digest.add(text, channels, window)
 
 
 _LABELS_FORMAT = '''{{
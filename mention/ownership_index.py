@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+import re
+import logging
+import threading
+from collections import OrderedDict
+
+from mention import config
+from mention import gitlab_client
+
+logger = logging.getLogger(__name__)
+
+_NULL_SHA = '0' * 40
+RE_HUNK = re.compile(r'\@\@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? \@\@')
+
+
+def apply_diff(authors, diff, author):
+    '''
+    Applies the hunks of a unified `diff` to a per-line author list: removed
+    lines are dropped and added lines are attributed to `author`. Returns
+    None if the diff doesn't fit the list, i.e. the entry is out of date.
+    '''
+    authors = list(authors)
+    idx = None
+    lines = diff.split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    for line in lines:
+        if line.startswith('@@'):
+            matched = RE_HUNK.match(line)
+            if matched is None:
+                return None
+            new_start, new_count = int(matched.group(1)), matched.group(2)
+            # an empty new side points at the line *before* the hunk
+            idx = new_start if new_count == '0' else new_start - 1
+            continue
+        # blank context lines sometimes come without their leading space
+        if idx is None or line.startswith('\\'):
+            continue
+        if line.startswith('-'):
+            if idx >= len(authors):
+                return None
+            del authors[idx]
+        elif line.startswith('+'):
+            authors.insert(idx, author)
+            idx += 1
+        else:
+            idx += 1
+        if idx > len(authors):
+            return None
+    return authors
+
+
+def _push_author(payload):
+    # added lines can only be attributed if the pusher wrote every commit;
+    # gitlab truncates the commit list, so the unlisted ones are unknown
+    if payload.get('total_commits_count', 0) > len(payload['commits']):
+        return None
+    emails = set(c.get('author', {}).get('email') for c in payload['commits'])
+    if emails == {payload.get('user_email')}:
+        return payload.get('user_username')
+    return None
+
+
+class OwnershipIndex(object):
+    '''
+    Author per line of files on a target branch, each entry tagged with the
+    commit sha it describes. Entries are seeded from blames and moved
+    forward by Push Hook events, so an MR against an unchanged branch head
+    can be answered without fetching any blame. At most `max_lines` lines
+    are kept, least recently used files are dropped first.
+    '''
+
+    def __init__(self, max_lines):
+        self.max_lines = max_lines
+        self._files = OrderedDict()
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def get(self, project_id, branch, commit_sha, path):
+        key = (project_id, branch, path)
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is None or entry[0] != commit_sha:
+                return None
+            self._files.move_to_end(key)
+            return entry[1]
+
+    def _put(self, key, commit_sha, authors):
+        self._pop(key)
+        self._files[key] = (commit_sha, authors)
+        self._lines += len(authors)
+
+    def _pop(self, key):
+        entry = self._files.pop(key, None)
+        if entry is not None:
+            self._lines -= len(entry[1])
+        return entry
+
+    def _evict(self):
+        while self._files and self._lines > self.max_lines:
+            _, (_, authors) = self._files.popitem(last=False)
+            self._lines -= len(authors)
+
+    def seed(self, project_id, branch, commit_sha, path, authors):
+        with self._lock:
+            self._put((project_id, branch, path), commit_sha, authors)
+            self._evict()
+
+    def _entries_at(self, project_id, branch, commit_sha):
+        return [
+            key for key, entry in self._files.items()
+            if key[:2] == (project_id, branch) and entry[0] == commit_sha
+        ]
+
+    def wants(self, payload):
+        branch = payload['ref'].split('refs/heads/', 1)[-1]
+        with self._lock:
+            return bool(
+                self._entries_at(payload['project_id'], branch,
+                                 payload['before']))
+
+    def drop_branch(self, project_id, branch):
+        with self._lock:
+            for key in [k for k in self._files if k[:2] == (project_id,
+                                                             branch)]:
+                self._pop(key)
+
+    def apply_push(self, payload, diffs):
+        '''
+        Moves every entry at the push's `before` sha to its `after` sha,
+        applying `diffs` (the straight compare of the two) to touched files.
+        Entries that can't be brought forward are dropped.
+        '''
+        project_id = payload['project_id']
+        branch = payload['ref'].split('refs/heads/', 1)[-1]
+        author = _push_author(payload)
+        changed = {d['old_path']: d for d in diffs}
+        with self._lock:
+            for key in self._entries_at(project_id, branch, payload['before']):
+                _, authors = self._pop(key)
+                diff = changed.get(key[2])
+                if diff is not None:
+                    if diff.get('deleted_file') or author is None \
+                       or not diff.get('diff'):
+                        continue
+                    authors = apply_diff(authors, diff['diff'], author)
+                    if authors is None:
+                        continue
+                    key = (project_id, branch, diff['new_path'])
+                self._put(key, payload['after'], authors)
+            self._evict()
+
+
+def _compare_truncated(payload, compare):
+    '''
+    Whether files may be missing from the compare response: gitlab stops
+    listing diffs past its file and line limits without saying so, so every
+    file the push names must be there.
+    '''
+    if compare.get('compare_timeout'):
+        return True
+    if payload.get('total_commits_count', 0) > len(payload['commits']):
+        return True
+    listed = set()
+    for diff in compare['diffs']:
+        listed.update((diff['old_path'], diff['new_path']))
+    return any(path not in listed for commit in payload['commits']
+               for k in ('added', 'modified', 'removed')
+               for path in commit.get(k, []))
+
+
+index = OwnershipIndex(config.OWNERSHIP_INDEX_MAX_LINES)
+
+
+def update_from_push(payload):
+    if not index.wants(payload):
+        return
+    project_id = payload['project_id']
+    branch = payload['ref'].split('refs/heads/', 1)[-1]
+    before, after = payload['before'], payload['after']
+    # a deleted, force-pushed or rebased branch: the diff doesn't describe
+    # how the lines at `before` moved
+    if after == _NULL_SHA or \
+       not gitlab_client.is_ancestor(project_id, before, after):
+        index.drop_branch(project_id, branch)
+        logger.info('ownership index dropped {} of project {}: {}..{} is '
+                    'not a fast-forward'.format(branch, project_id, before,
+                                                after))
+        return
+    compare = gitlab_client.get_compare(project_id, before, after)
+    if _compare_truncated(payload, compare):
+        index.drop_branch(project_id, branch)
+        logger.info('ownership index dropped {} of project {}: compare of '
+                    '{}..{} is incomplete'.format(branch, project_id, before,
+                                                  after))
+        return
+    index.apply_push(payload, compare['diffs'])
+    logger.info('ownership index moved to {}: project={}; ref={}'.format(
+        after, project_id, payload['ref']))
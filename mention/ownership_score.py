@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import heapq
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SECONDS_PER_DAY = 86400
+
+
+def parse_timestamp(value):
+    '''
+    Epoch seconds of an ISO 8601 datetime as found in blame pages, or None.
+    '''
+    # datetime.fromisoformat and a '+hh:mm' %z need python 3.7
+    try:
+        if value.endswith('Z'):
+            value = value[:-1] + '+0000'
+        elif value[-3:-2] == ':' and value[-6:-5] in ('+', '-'):
+            value = value[:-3] + value[-2:]
+        return int(
+            datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z').timestamp())
+    except (AttributeError, ValueError):
+        return None
+
+
+def split_entry(entry):
+    '''
+    A blame line is either an author or an [author, committed_at] pair,
+    `committed_at` being epoch seconds (or None when unknown).
+    '''
+    if isinstance(entry, str):
+        return entry, None
+    return entry[0], entry[1]
+
+
+def authors_only(blame):
+    return [entry if isinstance(entry, str) else entry[0] for entry in blame]
+
+
+def decay(age_seconds, half_life_days):
+    return 0.5**(max(age_seconds, 0) / (half_life_days * SECONDS_PER_DAY))
+
+
+class OwnerScores(object):
+    '''
+    Deleted-line and all-line ownership score per author. Authors are
+    numbered in order of first appearance in the blames; `first_deleted[i]`
+    is the position of the first deleted line owned by author `i`.
+    '''
+
+    def __init__(self, authors, deleted, total, first_deleted):
+        self.authors = authors
+        self.deleted = deleted
+        self.total = total
+        self.first_deleted = first_deleted
+
+    def __repr__(self):
+        return 'OwnerScores(deleted={}, total={})'.format(
+            self.deleted_owners(), self.all_owners())
+
+    def deleted_owners(self):
+        ids = sorted((i for i, score in enumerate(self.deleted) if score),
+                     key=lambda i: self.first_deleted[i])
+        return {self.authors[i]: self.deleted[i] for i in ids}
+
+    def all_owners(self):
+        return {
+            author: score
+            for author, score in zip(self.authors, self.total) if score
+        }
+
+    def ranked(self):
+        '''
+        Yield authors of deleted lines by deleted score, then the remaining
+        authors by all-line score. Ties keep the order of first appearance.
+        The ordering is built lazily so callers can stop at the top k.
+        '''
+        heap = [(-self.deleted[i], self.first_deleted[i], i)
+                for i, score in enumerate(self.deleted) if score]
+        heapq.heapify(heap)
+        while heap:
+            yield self.authors[heapq.heappop(heap)[2]]
+        heap = [(-self.total[i], i) for i, score in enumerate(self.total)
+                if score and not self.deleted[i]]
+        heapq.heapify(heap)
+        while heap:
+            yield self.authors[heapq.heappop(heap)[1]]
+
+
+def _encode(blame, vocab, dated):
+    if not dated:
+        return [
+            vocab.setdefault(author, len(vocab))
+            for author in authors_only(blame)
+        ], None
+    ids, dates = [], []
+    for entry in blame:
+        author, committed_at = split_entry(entry)
+        ids.append(vocab.setdefault(author, len(vocab)))
+        dates.append(committed_at)
+    return ids, dates
+
+
+def _score_python(files, blames, half_life_days, now):
+    vocab = {}
+    deleted, total, first_deleted = [], [], []
+    position = 0
+    for file_path, deleted_lines in files:
+        blame = blames.get(file_path)
+        if not blame:
+            continue
+        ids, dates = _encode(blame, vocab, half_life_days)
+        if dates is None:
+            weights = [1] * len(ids)
+        else:
+            weights = [
+                1.0 if d is None else decay(now - d, half_life_days)
+                for d in dates
+            ]
+        grow = len(vocab) - len(total)
+        deleted += [0] * grow
+        total += [0] * grow
+        first_deleted += [None] * grow
+        for i, w in zip(ids, weights):
+            total[i] += w
+        for line in deleted_lines:
+            if not 0 < line <= len(ids):
+                continue
+            if not split_entry(blame[line - 1])[0]:
+                continue
+            i = ids[line - 1]
+            deleted[i] += weights[line - 1]
+            if first_deleted[i] is None:
+                first_deleted[i] = position
+            position += 1
+    authors = sorted(vocab, key=vocab.get)
+    return OwnerScores(authors, deleted, total, first_deleted)
+
+
+def _score_numpy(files, blames, half_life_days, now):
+    vocab = {}
+    all_ids, all_weights, deleted_ids, deleted_weights = [], [], [], []
+    for file_path, deleted_lines in files:
+        blame = blames.get(file_path)
+        if not blame:
+            continue
+        ids, dates = _encode(blame, vocab, half_life_days)
+        ids = np.asarray(ids, dtype=np.intp)
+        if dates is None:
+            weights = np.ones(len(ids))
+        else:
+            dates = np.array([np.nan if d is None else d for d in dates],
+                             dtype=float)
+            ages = np.maximum(now - dates, 0)
+            weights = np.where(
+                np.isnan(dates), 1.0,
+                0.5**(ages / (half_life_days * SECONDS_PER_DAY)))
+        lines = np.asarray(deleted_lines, dtype=np.intp) - 1
+        lines = lines[(lines >= 0) & (lines < len(ids))]
+        all_ids.append(ids)
+        all_weights.append(weights)
+        deleted_ids.append(ids[lines])
+        deleted_weights.append(weights[lines])
+
+    n = len(vocab)
+    authors = sorted(vocab, key=vocab.get)
+    if not n:
+        return OwnerScores(authors, [], [], [])
+    all_ids = np.concatenate(all_ids)
+    deleted_ids = np.concatenate(deleted_ids)
+    deleted_weights = np.concatenate(deleted_weights)
+    if '' in vocab:
+        keep = deleted_ids != vocab['']
+        deleted_ids, deleted_weights = deleted_ids[keep], deleted_weights[keep]
+
+    if half_life_days:
+        total = np.bincount(all_ids, np.concatenate(all_weights), n)
+        deleted = np.bincount(deleted_ids, deleted_weights, n)
+    else:
+        total = np.bincount(all_ids, minlength=n)
+        deleted = np.bincount(deleted_ids, minlength=n)
+    first_deleted = [None] * n
+    unique, first = np.unique(deleted_ids, return_index=True)
+    for i, pos in zip(unique.tolist(), first.tolist()):
+        first_deleted[i] = pos
+    return OwnerScores(authors, deleted.tolist(), total.tolist(),
+                       first_deleted)
+
+
+def score_owners(files, blames, half_life_days=0, now=None):
+    '''
+    Score the authors of `blames` ({path: [blame line]}) for the deleted
+    lines in `files` ([(path, [deleted line no])]). With `half_life_days`,
+    a line's weight halves for every `half_life_days` since it was
+    committed; lines without a date keep full weight.
+    '''
+    if now is None:
+        now = time.time()
+    if np is not None:
+        return _score_numpy(files, blames, half_life_days, now)
+    return _score_python(files, blames, half_life_days, now)
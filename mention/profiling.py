@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import sys
+import time
+import logging
+import cProfile
+import threading
+from collections import Counter
+
+from mention import config
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sample')
+_EXTENSIONS = {'cprofile': '.prof', 'sample': '.folded'}
+
+
+def payload_project(payload):
+    if payload.get('object_kind') == 'push':
+        return payload.get('project_id')
+    return payload.get('object_attributes', {}).get('target_project_id')
+
+
+def _payload_label(payload):
+    if payload.get('object_kind') == 'push':
+        return 'push-{}'.format(payload.get('after', '')[:8])
+    return 'mr-{}'.format(payload.get('object_attributes', {}).get('iid'))
+
+
+class StackSampler(object):
+    '''
+    Samples the stack of one thread every `interval` seconds from a helper
+    thread, counting identical stacks. Saved in the folded format read by
+    flamegraph.pl and speedscope.
+    '''
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+class Profiler(object):
+    '''
+    Profiles the next `jobs` payload jobs once armed, optionally only the
+    jobs of one project, and saves one file per job under `directory`.
+    `armed` is all the payload workers look at while it is off.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.armed = False
+        self._jobs = 0
+        self._project_id = None
+        self._mode = 'cprofile'
+        self._lock = threading.Lock()
+        # newer pythons allow a single active cProfile per process
+        self._cprofile_lock = threading.Lock()
+
+    def arm(self, jobs=1, project_id=None, mode='cprofile'):
+        if mode not in MODES:
+            raise ValueError('unknown profiling mode: {}'.format(mode))
+        if jobs < 1:
+            raise ValueError('jobs must be at least 1')
+        # fail here rather than in the jobs that get profiled
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._jobs = jobs
+            self._project_id = project_id
+            self._mode = mode
+            self.armed = True
+        logger.info('profiling armed: jobs={}; project={}; mode={}'.format(
+            jobs, project_id, mode))
+
+    def disarm(self):
+        with self._lock:
+            self._jobs = 0
+            self.armed = False
+
+    def status(self):
+        with self._lock:
+            return {
+                'armed': self.armed,
+                'jobs': self._jobs,
+                'project_id': self._project_id,
+                'mode': self._mode,
+            }
+
+    def _claim(self, payload):
+        with self._lock:
+            if not self.armed:
+                return None
+            if self._project_id is not None and \
+               str(payload_project(payload)) != str(self._project_id):
+                return None
+            self._jobs -= 1
+            self.armed = self._jobs > 0
+            return self._mode
+
+    def _unclaim(self):
+        with self._lock:
+            self._jobs += 1
+            self.armed = True
+
+    def _path(self, payload, mode):
+        name = '{}-{}-{}-{}{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'), payload_project(payload),
+            _payload_label(payload), threading.get_ident(), _EXTENSIONS[mode])
+        return os.path.join(self.directory, name)
+
+    def run(self, fn, payload):
+        '''
+        Calls fn(payload), profiling it if the job is one of those asked for.
+        '''
+        mode = self._claim(payload)
+        if mode is None:
+            return fn(payload)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError:
+            logger.exception('cannot create {}, job not profiled'.format(
+                self.directory))
+            return fn(payload)
+        if mode == 'cprofile' and not self._cprofile_lock.acquire(False):
+            # another worker is being profiled, leave the slot to a later job
+            self._unclaim()
+            return fn(payload)
+        path = self._path(payload, mode)
+        started = time.monotonic()
+        if mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            stop, save = profile.disable, profile.dump_stats
+        else:
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            stop, save = sampler.stop, sampler.dump
+        try:
+            return fn(payload)
+        finally:
+            stop()
+            if mode == 'cprofile':
+                self._cprofile_lock.release()
+            save(path)
+            logger.info('profile saved to {}: took={:.2f}s'.format(
+                path, time.monotonic() - started))
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [{
+            'name': name,
+            'size': os.path.getsize(os.path.join(self.directory, name)),
+        } for name in sorted(os.listdir(self.directory))
+                if name.endswith(tuple(_EXTENSIONS.values()))]
+
+    def path(self, name):
+        '''
+        Path of a saved profile, or None if `name` isn't one.
+        '''
+        if name not in {p['name'] for p in self.list()}:
+            return None
+        return os.path.join(self.directory, name)
+
+
+profiler = Profiler(config.PROFILE_DIR)
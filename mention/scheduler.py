@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DelayScheduler(object):
+    '''
+    Heap of items ordered by the (monotonic) time they become due. A single
+    thread hands every item to `dispatch` as soon as it is due, so one
+    waiting item never holds back others that are already old enough.
+    '''
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, due, item):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), item))
+            self._cond.notify()
+
+    def pop_due(self, now):
+        with self._cond:
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+            return due
+
+    def run_pending(self, now=None):
+        for item in self.pop_due(time.monotonic() if now is None else now):
+            self.dispatch(item)
+
+    def _wait(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while not self._stopped:
+            self._wait()
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception('dispatching scheduled items failed')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
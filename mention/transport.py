@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from mention import config
+from mention import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    '''
+    Caps retries at `ratio` of the requests made in the last `window`
+    seconds (but always allows `minimum`), so a struggling gitlab gets
+    fewer requests from us instead of a multiple of them.
+    '''
+
+    def __init__(self, ratio, minimum, window=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.retries = 0
+        self.exhausted = 0
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        for q in (self._requests, self._retries):
+            while q and q[0] < now - self.window:
+                q.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = max(self.minimum, len(self._requests) * self.ratio)
+            if len(self._retries) >= allowed:
+                self.exhausted += 1
+                return False
+            self._retries.append(now)
+            self.retries += 1
+            return True
+
+
+retry_budget = RetryBudget(config.HTTP_RETRY_BUDGET,
+                           config.HTTP_RETRY_BUDGET_MIN)
+metrics.registry.counter('mention_http_retries_total',
+                         'HTTP requests retried by the shared transport',
+                         fn=lambda: retry_budget.retries)
+metrics.registry.counter('mention_http_retry_budget_exhausted_total',
+                         'HTTP retries refused by the retry budget',
+                         fn=lambda: retry_budget.exhausted)
+
+
+class BudgetedRetry(Retry):
+    '''
+    urllib3 Retry with full jitter on the backoff, drawing every retry from
+    the shared retry budget.
+    '''
+    budget = retry_budget
+
+    def get_backoff_time(self):
+        return random.uniform(0, super(BudgetedRetry, self).get_backoff_time())
+
+    def increment(self, *args, **kwargs):
+        if not self.budget.withdraw():
+            logger.warning('retry budget exhausted, giving up')
+            return super(BudgetedRetry, self.new(total=0)).increment(
+                *args, **kwargs)
+        return super(BudgetedRetry, self).increment(*args, **kwargs)
+
+
+class TransportAdapter(HTTPAdapter):
+    '''
+    Applies the default (connect, read) timeout to requests made without
+    one and records every request towards the retry budget.
+    '''
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TransportAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        retry_budget.record_request()
+        return super(TransportAdapter, self).send(request, **kwargs)
+
+
+def get_timeout():
+    return (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+
+
+def new_session():
+    '''
+    requests.Session shared by the python-gitlab client and the scraped
+    blame pages: pooled keep-alive connections, timeouts on every call and
+    retries on connection errors and 5xx for idempotent methods.
+    '''
+    retry = BudgetedRetry(total=config.HTTP_RETRIES,
+                          backoff_factor=config.HTTP_BACKOFF,
+                          status_forcelist=[500, 502, 503, 504],
+                          raise_on_status=False)
+    adapter = TransportAdapter(get_timeout(),
+                               pool_connections=config.HTTP_POOL_SIZE,
+                               pool_maxsize=config.HTTP_POOL_SIZE,
+                               max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+import logging
+import threading
+
+from mention import config
+from mention import gitlab_client
+
+logger = logging.getLogger(__name__)
+
+
+class UserDirectory(object):
+    '''
+    Set of active gitlab usernames, refreshed in the background once it is
+    older than `ttl` seconds. Until the first refresh lands, callers fall
+    back to looking up the individual usernames they care about.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._active_users = None
+        self._loaded_at = 0
+        self._candidates = {}
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def is_stale(self):
+        return time.time() - self._loaded_at > self.ttl
+
+    def refresh(self):
+        started = time.time()
+        active_users = set(gitlab_client.get_active_users())
+        with self._lock:
+            self._active_users = active_users
+            self._loaded_at = time.time()
+            self._candidates = {}
+        logger.info('user directory refreshed: users={}; took={:.2f}s'.format(
+            len(active_users), time.time() - started))
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception('user directory refresh failed')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        worker = threading.Thread(target=self._refresh_in_background)
+        worker.daemon = True
+        worker.start()
+
+    def _lookup_candidate(self, username, ctx=None):
+        now = time.time()
+        cached = self._candidates.get(username)
+        if cached and now - cached[1] <= self.ttl:
+            return cached[0]
+        active = gitlab_client.is_active_user(username, ctx)
+        self._candidates[username] = (active, now)
+        return active
+
+    def is_active(self, username, ctx=None):
+        active_users = self._active_users
+        if active_users is None or self.is_stale():
+            self.refresh_async()
+        if active_users is None:
+            return self._lookup_candidate(username, ctx)
+        return username in active_users
+
+
+directory = UserDirectory(config.USER_DIRECTORY_TTL)
+
+
+def is_active(username, ctx=None):
+    return directory.is_active(username, ctx)
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Entry point for gunicorn: payload workers start, and the journal is
+replayed, as soon as each worker process imports the app instead of with
+the first webhook after a restart.
+
+    gunicorn mention.wsgi:app -w 1 -b :8080
+'''
+from mention.app import app, start_workers
+
+start_workers()
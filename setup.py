@@ -20,7 +20,7 @@ setup(
     author='lfyzjck',
     author_email='jickimkim@gmail.com',
     url='https://github.com/lfyzjck/mention-bot.git',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     install_requires=[
         'Flask',
@@ -0,0 +1,37 @@
+import shutil
+import tempfile
+import unittest
+
+from mention.mention_bot import parse_blame, parse_diff
+from mention.mention_bot import iter_blame_lines
+from benchmarks import generators
+from benchmarks import run
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generated_inputs_parse(self):
+        blame = generators.make_blame_html(500, 20)
+        lines = list(iter_blame_lines([blame]))
+        self.assertEqual(len(lines), 500)
+        self.assertEqual(len(set(sha for _, sha, _ in lines)), 20)
+        self.assertTrue(all(author in generators.AUTHORS
+                            for author in parse_blame(blame)))
+        self.assertTrue(all(ts for _, _, ts in lines))
+
+        changes = generators.make_diff(10, 3, 12)
+        files = parse_diff(changes)
+        self.assertEqual([f for f, _ in files],
+                         [c['old_path'] for c in changes])
+        self.assertTrue(any(deleted for _, deleted in files))
+        self.assertEqual(generators.make_diff(10, 3, 12), changes)
+
+    def test_save_and_compare(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        results = {'parse_diff[realistic]': {'min': 1.0, 'median': 1.0}}
+        path = run.save(results, tmpdir)
+        self.assertEqual(run.load(path), results)
+        slower = {'parse_diff[realistic]': {'min': 1.2, 'median': 1.2}}
+        self.assertEqual(run.compare(results, slower, 0.1),
+                         ['parse_diff[realistic]'])
+        self.assertEqual(run.compare(results, slower, 0.5), [])
@@ -0,0 +1,66 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import mock
+
+from mention import mention_bot
+from mention.blame_cache import BlameCache
+
+
+class TestBlameCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'blame.sqlite')
+
+    def test_persistent(self):
+        cache = BlameCache(self.path, 1024 * 1024)
+        self.assertIsNone(cache.get('p/higgs', 'abc', 'a.py'))
+        cache.put('p/higgs', 'abc', 'a.py', ['ck', 'iven'])
+        reopened = BlameCache(self.path, 1024 * 1024)
+        self.assertEqual(reopened.get('p/higgs', 'abc', 'a.py'), ['ck', 'iven'])
+        self.assertIsNone(reopened.get('p/higgs', 'def', 'a.py'))
+
+    def test_lru_eviction(self):
+        cache = BlameCache(self.path, 1024 * 1024, touch_interval=0)
+        authors = ['user{}'.format(i) for i in range(2000)]
+        cache.put('p/higgs', 'abc', 'a.py', authors)
+        size = cache._connect().execute(
+            'SELECT size FROM blames').fetchone()[0]
+        cache.max_bytes = size * 2
+        cache.put('p/higgs', 'abc', 'b.py', authors)
+        cache.get('p/higgs', 'abc', 'a.py')
+        cache.put('p/higgs', 'abc', 'c.py', authors)
+        self.assertIsNotNone(cache.get('p/higgs', 'abc', 'a.py'))
+        self.assertIsNone(cache.get('p/higgs', 'abc', 'b.py'))
+        self.assertIsNotNone(cache.get('p/higgs', 'abc', 'c.py'))
+
+    def test_hits_and_puts_without_scans(self):
+        cache = BlameCache(self.path, 1024 * 1024)
+        cache.put('p/higgs', 'abc', 'a.py', ['ck'])
+        cache.put('p/higgs', 'abc', 'a.py', ['ck', 'iven'])
+        self.assertEqual(cache._total, cache._stored_bytes(cache._connect()))
+        changes = cache._connect().total_changes
+        # a recently used entry is served without writing its access time
+        self.assertEqual(cache.get('p/higgs', 'abc', 'a.py'), ['ck', 'iven'])
+        self.assertEqual(cache._connect().total_changes, changes)
+        with mock.patch('time.time', return_value=time.time() + 120):
+            cache.get('p/higgs', 'abc', 'a.py')
+        self.assertEqual(cache._connect().total_changes, changes + 1)
+
+    @mock.patch('mention.gitlab_client.get_branch_head')
+    @mock.patch('mention.gitlab_client.fetch_blame')
+    def test_get_files_blames_uses_cache(self, fetch_blame, get_branch_head):
+        with open('tests/data/test.blame') as f:
+            fetch_blame.return_value = f.read()
+        get_branch_head.return_value = 'abc'
+        files = [('ccgh/README.md', [1])]
+        with mock.patch('mention.blame_cache.cache',
+                        BlameCache(self.path, 1024 * 1024)):
+            first = mention_bot.get_files_blames('p/higgs', 'master', files)
+            second = mention_bot.get_files_blames('p/higgs', 'master', files)
+        self.assertEqual(first, second)
+        fetch_blame.assert_called_once_with('p/higgs', 'abc', 'ccgh/README.md',
+                                            ctx=None)
@@ -2,9 +2,13 @@
 # coding: utf-8
 from __future__ import absolute_import
 
+import json
+import time
+import datetime
 import mock
 import flask_testing
 
+from mention import app as bot_app
 from mention.app import app
 from mention.mention_bot import BotConfig
 from mention.config import get_default_config
@@ -50,3 +54,109 @@ class TestBot(flask_testing.TestCase):
             response = self.client.post('/', data=data, headers=headers)
             self.assertEqual(response.status_code, 200)
         add_comment.assert_called()
+
+    def _flush(self):
+        # pretend every scheduled event is due
+        with mock.patch('time.monotonic', return_value=float('inf')):
+            bot_app.scheduler.run_pending()
+
+    def _drain(self):
+        self._flush()
+        jobs = []
+        for q in bot_app.enclosure_queues:
+            while not q.empty():
+                jobs.append(q.get_nowait())
+        return jobs
+
+    @mock.patch('mention.config.COALESCE_WINDOW', 0)
+    def test_webhook_same_mr_same_lane(self):
+        headers = {'X-Gitlab-Event': 'Merge Request Hook'}
+        with open('tests/data/merge_request_event.json') as f:
+            data = f.read()
+        self._drain()
+        for _ in range(3):
+            self.client.post('/', data=data, headers=headers)
+        # nothing reaches the workers before the delay has passed
+        bot_app.scheduler.run_pending()
+        self.assertEqual(sum(q.qsize() for q in bot_app.enclosure_queues), 0)
+        self._flush()
+        sizes = [q.qsize() for q in bot_app.enclosure_queues]
+        self._drain()
+        self.assertEqual(max(sizes), 3)
+        self.assertEqual(sum(sizes), 3)
+
+    def test_webhook_coalesce(self):
+        headers = {'X-Gitlab-Event': 'Merge Request Hook'}
+        with open('tests/data/merge_request_event.json') as f:
+            payload = json.loads(f.read())
+        self._drain()
+        for action, title in [('open', 'first'), ('update', 'second'),
+                              ('update', 'third')]:
+            payload['object_attributes']['action'] = action
+            payload['object_attributes']['title'] = title
+            self.client.post('/', data=json.dumps(payload), headers=headers)
+        jobs = self._drain()
+        self.assertEqual(len(jobs), 1)
+        attrs = jobs[0][1]['object_attributes']
+        self.assertEqual(attrs['action'], 'open')
+        self.assertEqual(attrs['title'], 'third')
+
+    @mock.patch('mention.config.PAYLOAD_DELAYS', {'update': 60, 'merge': 0})
+    @mock.patch('mention.config.COALESCE_WINDOW', 30)
+    def test_schedule_keeps_mr_order(self):
+        with open('tests/data/merge_request_event.json') as f:
+            payload = json.loads(f.read())
+        self._drain()
+        t0 = datetime.datetime.now()
+        update = dict(payload, object_attributes=dict(
+            payload['object_attributes'], action='update'))
+        merge = dict(payload, object_attributes=dict(
+            payload['object_attributes'], action='merge'))
+        bot_app._schedule(update, t0, [])
+        bot_app._schedule(merge, t0 + datetime.timedelta(seconds=40), [])
+        # the merge is not due before the update it follows
+        bot_app.scheduler.run_pending(time.monotonic() + 30)
+        self.assertEqual(sum(q.qsize() for q in bot_app.enclosure_queues), 0)
+        jobs = self._drain()
+        self.assertEqual([job[1]['object_attributes']['action']
+                          for job in jobs], ['update', 'merge'])
+
+    def test_metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.data.decode('utf-8')
+        for name in ['mention_stage_seconds', 'mention_queue_lag_seconds',
+                     'mention_queue_depth{lane="0"}',
+                     'mention_http_retries_total',
+                     'mention_slack_messages_total{outcome="failed"}']:
+            self.assertIn(name, body)
+
+    @mock.patch('mention.config.DEBUG_ROUTES', True)
+    @mock.patch('mention.app.profiler')
+    def test_debug_profiles(self, profiler):
+        profiler.status.return_value = {'armed': True}
+        profiler.list.return_value = [{'name': 'a.prof', 'size': 1}]
+        profiler.path.return_value = None
+        response = self.client.post('/debug/profiles',
+                                    data=json.dumps({'jobs': 3,
+                                                     'project_id': 9}))
+        self.assertEqual(response.status_code, 200)
+        profiler.arm.assert_called_once_with(3, 9, 'cprofile')
+        response = self.client.get('/debug/profiles')
+        self.assertEqual(json.loads(response.data)['profiles'][0]['name'],
+                         'a.prof')
+        self.assertEqual(self.client.get('/debug/profiles/x').status_code,
+                         404)
+
+    @mock.patch('mention.config.DEBUG_ROUTES', True)
+    @mock.patch('mention.app.profiler')
+    def test_debug_profiles_bad_body(self, profiler):
+        for body in ['{"jobs": ', '[1]', '{"jobs": null}', '{"jobs": "x"}']:
+            response = self.client.post('/debug/profiles', data=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', json.loads(response.data))
+        profiler.arm.assert_not_called()
+
+    def test_debug_profiles_disabled(self):
+        self.assertEqual(self.client.get('/debug/profiles').status_code, 404)
@@ -0,0 +1,75 @@
+import unittest
+import mock
+
+from mention import config_cache
+
+
+def _push(paths, ref='refs/heads/master'):
+    return {
+        'object_kind': 'push',
+        'project_id': 90,
+        'ref': ref,
+        'after': 'a' * 40,
+        'total_commits_count': 1,
+        'commits': [{'added': [], 'modified': paths, 'removed': []}],
+    }
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = config_cache.ConfigCache(ttl=60)
+        patcher = mock.patch.object(config_cache, 'cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('mention.gitlab_client.get_project_file')
+    @mock.patch('mention.gitlab_client.get_project_file_blob_id')
+    def test_parsed_once_per_blob(self, get_project_file_blob_id,
+                                  get_project_file):
+        get_project_file_blob_id.return_value = 'blob1'
+        get_project_file.return_value = '{"maxReviewers": 5}'
+        for _ in range(3):
+            cfg = config_cache.get_repo_config(90, 'master', '.mention-bot')
+            self.assertEqual(cfg.maxReviewers, 5)
+        self.assertEqual(get_project_file_blob_id.call_count, 1)
+        self.assertEqual(get_project_file.call_count, 1)
+
+        # after the ttl the blob id is rechecked, content only on change
+        self.cache._blob_ids[(90, 'master', '.mention-bot')] = ('blob1', 0)
+        config_cache.get_repo_config(90, 'master', '.mention-bot')
+        self.assertEqual(get_project_file_blob_id.call_count, 2)
+        self.assertEqual(get_project_file.call_count, 1)
+
+        self.cache._blob_ids[(90, 'master', '.mention-bot')] = ('blob1', 0)
+        get_project_file_blob_id.return_value = 'blob2'
+        get_project_file.return_value = '{"maxReviewers": 7}'
+        cfg = config_cache.get_repo_config(90, 'master', '.mention-bot')
+        self.assertEqual(cfg.maxReviewers, 7)
+        self.assertNotIn((90, 'master', 'blob1'), self.cache._configs)
+
+    @mock.patch('mention.gitlab_client.get_project_file')
+    @mock.patch('mention.gitlab_client.get_project_file_blob_id')
+    def test_missing_config_uses_default(self, get_project_file_blob_id,
+                                         get_project_file):
+        get_project_file_blob_id.return_value = None
+        cfg = config_cache.get_repo_config(90, 'master', '.mention-bot')
+        self.assertEqual(cfg.maxReviewers, 3)
+        get_project_file.assert_not_called()
+
+    @mock.patch('mention.gitlab_client.get_project_file')
+    @mock.patch('mention.gitlab_client.get_project_file_blob_id')
+    def test_invalidate_for_push(self, get_project_file_blob_id,
+                                 get_project_file):
+        get_project_file_blob_id.return_value = 'blob1'
+        get_project_file.return_value = '{}'
+        config_cache.get_repo_config(90, 'master', '.mention-bot')
+
+        config_cache.invalidate_for_push(_push(['README.md']))
+        config_cache.invalidate_for_push(
+            _push(['.mention-bot'], ref='refs/heads/other'))
+        config_cache.get_repo_config(90, 'master', '.mention-bot')
+        self.assertEqual(get_project_file_blob_id.call_count, 1)
+
+        config_cache.invalidate_for_push(_push(['.mention-bot']))
+        config_cache.get_repo_config(90, 'master', '.mention-bot')
+        self.assertEqual(get_project_file_blob_id.call_count, 2)
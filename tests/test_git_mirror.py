@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+import mock
+
+from mention import config
+from mention import git_mirror
+from mention import mention_bot
+
+
+def _commit(repo, email, content):
+    with open(os.path.join(repo, 'f.txt'), 'w') as f:
+        f.write(content)
+    subprocess.check_call(['git', 'add', 'f.txt'], cwd=repo)
+    subprocess.check_call([
+        'git', '-c', 'user.name=x', '-c', 'user.email=' + email, 'commit',
+        '-q', '-m', email
+    ], cwd=repo)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=repo).decode().strip()
+
+
+class TestGitMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.origin = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(self.origin)
+        subprocess.check_call(['git', 'init', '-q', '-b', 'master'],
+                              cwd=self.origin)
+        _commit(self.origin, 'ck@example.com', 'a\nb\nc\n')
+        self.head = _commit(self.origin, 'iven@example.com', 'a\nB\nc\nd\n')
+
+        patchers = [
+            mock.patch.object(config, 'GIT_MIRROR_DIR',
+                              os.path.join(self.tmpdir, 'mirrors')),
+            mock.patch('mention.git_mirror.clone_url',
+                       lambda namespace: self.origin),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_blame(self):
+        git_mirror.ensure_mirror('p/higgs', self.head)
+        self.assertEqual(git_mirror.blame('p/higgs', self.head, 'f.txt'),
+                         ['ck', 'iven', 'ck', 'iven'])
+        self.assertEqual(
+            git_mirror.blame('p/higgs', self.head, 'f.txt', [(2, 3)]),
+            ['none', 'iven', 'ck'])
+        self.assertEqual(git_mirror.blame('p/higgs', self.head, 'missing'),
+                         [])
+
+        dated = git_mirror.blame('p/higgs', self.head, 'f.txt', dated=True)
+        self.assertEqual([author for author, _ in dated],
+                         ['ck', 'iven', 'ck', 'iven'])
+        self.assertTrue(all(isinstance(ts, int) for _, ts in dated))
+
+    def test_incremental_fetch(self):
+        git_mirror.ensure_mirror('p/higgs', self.head)
+        head = _commit(self.origin, 'fsp@example.com', 'z\n')
+        git_mirror.ensure_mirror('p/higgs', head)
+        self.assertEqual(git_mirror.blame('p/higgs', head, 'f.txt'), ['fsp'])
+
+    @mock.patch('mention.gitlab_client.get_branch_head')
+    def test_get_files_blames_mirror_backend(self, get_branch_head):
+        get_branch_head.return_value = self.head
+        blames = mention_bot.get_files_blames('p/higgs', 'master',
+                                              [('f.txt', [2])], 4, 'mirror')
+        self.assertEqual(blames, {'f.txt': ['ck', 'iven', 'ck', 'iven']})
+
+
+
+class TestMirrorAuth(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patchers = [
+            mock.patch.object(config, 'GIT_MIRROR_DIR', self.tmpdir),
+            mock.patch.object(config, 'GITLAB_URL', 'http://127.0.0.1:1'),
+            mock.patch.object(config, 'GITLAB_TOKEN', 'SECRETTOK'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_kept_out_of_urls(self):
+        self.assertEqual(git_mirror.clone_url('g/p'),
+                         'http://127.0.0.1:1/g/p.git')
+        env = git_mirror._auth_env()
+        self.assertEqual(env['GIT_CONFIG_KEY_0'], 'http.extraHeader')
+        self.assertTrue(
+            env['GIT_CONFIG_VALUE_0'].startswith('Authorization: Basic '))
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            git_mirror.ensure_mirror('g/p')
+        self.assertNotIn('SECRETTOK', str(raised.exception))
+
+    @mock.patch('mention.gitlab_client.fetch_blame')
+    @mock.patch('mention.gitlab_client.get_branch_head')
+    def test_unreachable_mirror_falls_back_to_html(self, get_branch_head,
+                                                   fetch_blame):
+        get_branch_head.return_value = 'abc'
+        with open('tests/data/test.blame') as f:
+            fetch_blame.return_value = f.read()
+        with mock.patch('mention.blame_cache.cache.path', ''):
+            blames = mention_bot.get_files_blames('g/p', 'master',
+                                                  [('a.py', [1])], 1,
+                                                  'mirror')
+        self.assertTrue(blames['a.py'])
+        fetch_blame.assert_called_once_with('g/p', 'abc', 'a.py', ctx=None)
+
+    @mock.patch('subprocess.run')
+    def test_git_timeout(self, run):
+        run.side_effect = subprocess.TimeoutExpired(['git'], 1)
+        with mock.patch.object(config, 'GIT_TIMEOUT', 1):
+            self.assertEqual(git_mirror.blame('g/p', 'master', 'f.txt'), [])
+        self.assertEqual(run.call_args[1]['timeout'], 1)
@@ -0,0 +1,105 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from mention.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'queue.sqlite')
+
+    def _wait_for(self, journal, count):
+        for _ in range(100):
+            rows = journal._connect().execute(
+                'SELECT COUNT(*) FROM events').fetchone()[0]
+            if rows == count:
+                return
+            time.sleep(0.01)
+        self.fail('journal has {} events, expected {}'.format(rows, count))
+
+    def _lapse(self, journal, age=120):
+        # as if the process holding the events died `age` seconds ago
+        with journal._lock:
+            conn = journal._connect()
+            conn.execute('UPDATE events SET claimed_at=?, received=?',
+                         (time.time() - age, time.time() - age))
+            conn.commit()
+
+    def test_replay_until_acked(self):
+        journal = Journal(self.path, max_attempts=3)
+        first = journal.append({'n': 1})
+        second = journal.append({'n': 2})
+        self.assertIsNotNone(first)
+
+        # events held by a live process aren't replayed elsewhere
+        restarted = Journal(self.path, max_attempts=3)
+        self.assertEqual(restarted.pending(), [])
+
+        self._lapse(restarted)
+        pending = restarted.pending()
+        self.assertEqual([(i, p) for i, _, p in pending],
+                         [(first, {'n': 1}), (second, {'n': 2})])
+        # once claimed, no other process replays them
+        self.assertEqual(Journal(self.path, max_attempts=3).pending(), [])
+
+        restarted.ack([first, None])
+        self._wait_for(restarted, 1)
+        self._lapse(restarted)
+        self.assertEqual([i for i, _, _ in restarted.pending()], [second])
+
+    def test_drop_after_max_attempts(self):
+        journal = Journal(self.path, max_attempts=2)
+        event_id = journal.append({'n': 1})
+        # replaying alone doesn't spend attempts
+        for _ in range(3):
+            self._lapse(journal, age=61)
+            self.assertEqual(len(journal.pending()), 1)
+        journal.start([event_id])
+        journal.start([event_id, None])
+        self._lapse(journal, age=61)
+        self.assertEqual(journal.pending(), [])
+        self._wait_for(journal, 0)
+
+    def test_drop_too_old(self):
+        journal = Journal(self.path, max_attempts=3, max_age=3600)
+        journal.append({'n': 1})
+        self._lapse(journal, age=7200)
+        self.assertEqual(journal.pending(), [])
+        self._wait_for(journal, 0)
+
+    def test_migrates_old_journal(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE events (id INTEGER PRIMARY KEY '
+                     'AUTOINCREMENT, received REAL NOT NULL, payload TEXT '
+                     'NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)')
+        conn.execute('INSERT INTO events (received, payload) VALUES (?, ?)',
+                     (time.time(), '{"n": 1}'))
+        conn.commit()
+        conn.close()
+        journal = Journal(self.path, max_attempts=3)
+        self.assertEqual([p for _, _, p in journal.pending()], [{'n': 1}])
+
+    def test_concurrent_appends(self):
+        journal = Journal(self.path, max_attempts=3)
+        ids = []
+
+        def append(n):
+            ids.append(journal.append({'n': n}))
+
+        threads = [threading.Thread(target=append, args=(n, ))
+                   for n in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(ids)), 50)
+        self._lapse(journal)
+        self.assertEqual(sorted(p['n'] for _, _, p in journal.pending()),
+                         list(range(50)))
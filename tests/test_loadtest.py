@@ -0,0 +1,77 @@
+import os
+import json
+import unittest
+
+import mock
+import requests
+
+from benchmarks import loadtest
+from benchmarks.fake_gitlab import FakeGitlab, bot_config
+
+
+class TestLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGitlab(files=3, blame_lines=50).start()
+        self.addCleanup(self.fake.stop)
+
+    def test_fake_routes(self):
+        api = self.fake.url + '/api/v4/projects/1'
+        diffs = requests.get(api + '/merge_requests/7/diffs').json()
+        self.assertEqual(len(diffs), 3)
+        self.assertEqual(requests.get(api + '/merge_requests/7/diffs').json(),
+                         diffs)
+        head = requests.head(api + '/repository/files/.mention-bot',
+                             params={'ref': 'master'})
+        self.assertEqual(head.headers['X-Gitlab-Blob-Id'], 'c' * 40)
+        blame = requests.get(self.fake.url +
+                             '/load/project1/blame/master/a.py').text
+        self.assertEqual(blame.count('data-line-number='), 50)
+        self.assertEqual(requests.get(api + '/nothing').status_code, 404)
+        self.assertEqual(self.fake.calls['mr_diffs'], 2)
+        self.assertNotIn('nothing', self.fake.calls)
+
+    def test_injected_errors(self):
+        self.fake.error_rate = 1
+        response = requests.get(self.fake.url + '/api/v4/users')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.fake.errors['users'], 1)
+
+    def test_tracker(self):
+        tracker = loadtest.Tracker()
+        tracker.sent = {0: 1.0, 1: 1.0}
+        tracker.on_slack('no marker')
+        tracker.on_slack('root opened *!1*: loadtest-1- _(`load`)_')
+        self.assertFalse(tracker.wait(2, 0.01))
+        tracker.on_slack('root opened *!1*: loadtest-0- _(`load`)_')
+        self.assertTrue(tracker.wait(2, 0.01))
+        self.assertEqual(sorted(tracker.done), [0, 1])
+
+    def test_make_payload(self):
+        with open('tests/data/merge_request_event.json') as f:
+            template = json.load(f)
+        payload = loadtest.make_payload(template, 7, 5)
+        obj = payload['object_attributes']
+        self.assertEqual(obj['target_project_id'], 3)
+        self.assertEqual(obj['iid'], 8)
+        self.assertTrue(obj['title'].startswith(loadtest.MARKER + '7-'))
+        self.assertIn('', bot_config()['labels'])
+
+    def test_bot_env_points_at_fakes(self):
+        env = {'GITLAB_URL': 'https://gitlab.example.com',
+               'GITLAB_TOKEN': 'real', 'SLACK_TOKEN': 'real',
+               'SLACK_API_URL': 'https://slack.com/api/',
+               'PAYLOAD_DELAY': '5'}
+        with mock.patch.dict(os.environ, env):
+            loadtest._configure_bot_env(self.fake, None)
+            self.assertEqual(os.environ['GITLAB_URL'], self.fake.url)
+            self.assertEqual(os.environ['SLACK_API_URL'],
+                             self.fake.slack_url)
+            self.assertEqual(os.environ['GITLAB_TOKEN'], 'loadtest')
+            self.assertEqual(os.environ['SLACK_TOKEN'], 'loadtest')
+            self.assertEqual(os.environ['PAYLOAD_DELAY'], '5')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 51)
+        self.assertEqual(loadtest.percentile(values, 99), 100)
+        self.assertIsNone(loadtest.percentile([], 50))
@@ -0,0 +1,72 @@
+import json
+import logging
+import unittest
+import mock
+
+from mention import logs
+
+
+def _record(msg, *args, **extra):
+    record = logging.LogRecord('mention.test', logging.INFO, 'bot.py', 7, msg,
+                               args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestLogs(unittest.TestCase):
+    def test_json_formatter(self):
+        formatter = logs.JsonFormatter(max_field=10)
+        entry = json.loads(
+            formatter.format(
+                _record('payload=%s', 'x' * 25, project_id=3, blame='y' * 11,
+                        verbose=True)))
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['logger'], 'mention.test')
+        self.assertEqual(entry['loc'], 'bot.py:7')
+        self.assertEqual(entry['msg'], 'payload=xx...<23 more chars>')
+        self.assertEqual(entry['project_id'], 3)
+        self.assertEqual(entry['blame'], 'y' * 10 + '...<1 more chars>')
+        self.assertNotIn('verbose', entry)
+
+    def test_lazy_is_only_computed_when_formatted(self):
+        render = mock.Mock(return_value='rendered')
+        record = _record('payload=%s', logs.lazy(render, {'a': 1}),
+                         verbose=True)
+        self.assertFalse(logs.SampleFilter(0).filter(record))
+        render.assert_not_called()
+        self.assertEqual(record.getMessage(), 'payload=rendered')
+        # console, file and the rollover check all format it again
+        self.assertEqual(record.getMessage(), 'payload=rendered')
+        render.assert_called_once_with({'a': 1})
+
+    def test_sample_filter(self):
+        sampled = logs.SampleFilter(0.5)
+        with mock.patch('random.random', return_value=0.7):
+            self.assertFalse(sampled.filter(_record('x', verbose=True)))
+            self.assertTrue(sampled.filter(_record('x')))
+        with mock.patch('random.random', return_value=0.2):
+            self.assertTrue(sampled.filter(_record('x', verbose=True)))
+        self.assertTrue(logs.SampleFilter().filter(_record('x', verbose=True)))
+
+        # console and file handler filters agree on each record
+        console, log_file = logs.SampleFilter(0.5), logs.SampleFilter(0.5)
+        with mock.patch('random.random', side_effect=[0.7, 0.2]) as draw:
+            record = _record('x', verbose=True)
+            self.assertFalse(console.filter(record))
+            self.assertFalse(log_file.filter(record))
+        self.assertEqual(draw.call_count, 1)
+
+    def test_setup(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        self.addCleanup(setattr, root, 'handlers', handlers)
+        self.addCleanup(root.setLevel, level)
+        with mock.patch('logging.handlers.RotatingFileHandler._open'):
+            logs.setup('json', '/tmp/mention-bot-test.log', 100, 0.1)
+        self.assertTrue(root.handlers)
+        for handler in root.handlers:
+            self.assertIsInstance(handler.formatter, logs.JsonFormatter)
+            self.assertEqual(handler.formatter.max_field, 100)
+            self.assertEqual(handler.filters[0].rate, 0.1)
+        with self.assertRaises(ValueError):
+            logs.setup('xml', '/tmp/mention-bot-test.log')
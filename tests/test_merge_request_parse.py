@@ -3,15 +3,21 @@
 import unittest
 import mock
 import json
+import threading
 
+from mention import gitlab_client
 from mention.gitlab_client import setup_cookie, fetch_blame
-from mention.mention_bot import parse_diff_file
+from mention.gitlab_client import get_gitlab_client
+from mention.mention_bot import get_deleted_lines, parse_diff, iter_diff_files
 from mention.mention_bot import parse_blame, get_deleted_owners, get_all_owners
+from mention.mention_bot import parse_blame_stream, iter_blame_lines
 from mention.mention_bot import sort_owners, filter_files
 from mention.mention_bot import guess_owners, BotConfig
 from mention.mention_bot import get_repo_config
 from mention.mention_bot import is_valid
 from mention.mention_bot import add_comment
+from mention.mention_bot import get_files_blames
+from mention.blame_cache import BlameCache
 
 
 class TestMergeRequestParse(unittest.TestCase):
@@ -24,13 +30,63 @@ class TestMergeRequestParse(unittest.TestCase):
         self.assertFalse(
             add_comment(project_id, merge_request_id, 'ck', [], config))
 
-    def test_parse_diff_file(self):
+    def test_get_deleted_lines(self):
         with open('tests/data/test.diff') as f:
-            lines = f.read().split('\n')
-            lines = list(reversed(lines))
-            deleted_lines = parse_diff_file(lines)
+            deleted_lines = get_deleted_lines(f.read())
             assert len(deleted_lines) > 0
 
+    def test_parse_blame_stream(self):
+        with open('tests/data/test.blame') as f:
+            blame = f.read()
+        expected = parse_blame(blame)
+        self.assertTrue(len(expected) > 0)
+        for size in [1, 7, 100, 4096, len(blame)]:
+            chunks = [blame[i:i + size] for i in range(0, len(blame), size)]
+            self.assertEqual(parse_blame_stream(chunks), expected)
+        self.assertEqual(parse_blame_stream([]), [])
+
+    def test_iter_diff_files_matches_reversed_parser(self):
+        def pop_parser(lines):
+            # the previous implementation, fed reversed lines
+            deleted_lines = []
+            current_from_line = 0
+            while len(lines) > 0:
+                line = lines.pop()
+                if line.startswith('---') or line.startswith('+++'):
+                    continue
+                if line.startswith('@@'):
+                    current_from_line = int(line.split()[1][1:].split(',')[0])
+                    continue
+                if line.startswith('-'):
+                    deleted_lines.append(current_from_line)
+                if not line.startswith('+'):
+                    current_from_line += 1
+            return deleted_lines
+
+        with open('tests/data/test.diff') as f:
+            diff = f.read()
+        expected = pop_parser(list(reversed(diff.split('\n'))))
+        changes = [{'old_path': 'a.py', 'diff': diff},
+                   {'old_path': 'b.py', 'diff': diff + '\n'},
+                   {'old_path': 'c.py', 'diff': ''}]
+        files = iter_diff_files(changes)
+        self.assertEqual(next(files), ('a.py', expected))
+        self.assertEqual(list(files), [('b.py', expected), ('c.py', [])])
+        self.assertEqual(parse_diff(changes)[0], ('a.py', expected))
+        self.assertEqual(get_deleted_lines('@x\n-a\n+++ b\n--- a\n-b'),
+                         [1, 2])
+
+    def test_iter_blame_lines(self):
+        with open('tests/data/test.blame') as f:
+            blame = f.read()
+        lines = list(iter_blame_lines([blame]))
+        self.assertEqual([author for author, _, _ in lines],
+                         parse_blame(blame))
+        self.assertEqual(lines[0],
+                         ('jacek.sieka',
+                          '2487632232a2243a675137ec467332f4f7c3ef0b',
+                          1518766018))
+
     def test_get_owners(self):
         files = [
             ('test.py', [1, 2, 3]),
@@ -82,6 +138,35 @@ class TestMergeRequestParse(unittest.TestCase):
         self.assertEqual(files, [('b.py', [1, 2, 3, 5, 6]), ('xx.py',
                                                              [234, 456, 789])])
 
+    @mock.patch('mention.blame_cache.cache', BlameCache('', 0))
+    @mock.patch('mention.gitlab_client.setup_cookie')
+    @mock.patch('mention.gitlab_client.fetch_blame')
+    def test_get_files_blames_concurrent(self, fetch_blame, setup_cookie):
+        with open('tests/data/test.blame') as f:
+            blame = f.read()
+        fetch_blame.return_value = blame
+        files = [('a.py', [1]), ('b.py', [2]), ('c.py', [3])]
+        serial = get_files_blames('p/higgs', 'master', files)
+        concurrent = get_files_blames('p/higgs', 'master', files, 3)
+        self.assertEqual(list(concurrent.keys()), ['a.py', 'b.py', 'c.py'])
+        self.assertEqual(concurrent, serial)
+        self.assertEqual(concurrent['a.py'], parse_blame(blame))
+        self.assertEqual(fetch_blame.call_count, 6)
+
+    def test_filter_files_matches_full_sort(self):
+        from fnmatch import fnmatch
+        files = [('f{}.{}'.format(i, ext), list(range(i % 7)))
+                 for i in range(200) for ext in ('py', 'md', 'pb.go')]
+        fileBlackList = ['*.md', '*.pb.go', 'f1?.py']
+        expected = [
+            f for f in sorted(files, key=lambda f: len(f[1]), reverse=True)
+            if not any(fnmatch(f[0], p) for p in fileBlackList)
+        ][:10]
+        self.assertEqual(filter_files(files, fileBlackList, 10), expected)
+        self.assertEqual(filter_files(files, [], 3),
+                         sorted(files, key=lambda f: len(f[1]),
+                                reverse=True)[:3])
+
     def test_config(self):
         config = BotConfig.from_dict({
             'maxReviewers': 10,
@@ -90,6 +175,42 @@ class TestMergeRequestParse(unittest.TestCase):
         self.assertEqual(config.createComment, True)
         self.assertEqual(config.actions, ['open', 'reopen'])
 
+    @mock.patch('mention.gitlab_client.Gitlab')
+    @mock.patch('mention.transport.new_session')
+    def test_concurrent_login(self, new_session, Gitlab):
+        signing_in = threading.Event()
+        release = threading.Event()
+
+        def sign_in_page(url):
+            signing_in.set()
+            release.wait(5)
+            return mock.Mock(content=b'name="authenticity_token" value="t"')
+
+        new_session.return_value.get.side_effect = sign_in_page
+        new_session.return_value.post.return_value.status_code = 200
+        clients = []
+        with mock.patch('mention.gitlab_client.session', None), \
+                mock.patch('mention.gitlab_client._gitlab_client', None):
+            threads = [
+                threading.Thread(
+                    target=lambda: clients.append(get_gitlab_client()))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(signing_in.wait(5))
+            # nobody may use the session before its login is done
+            self.assertIsNone(gitlab_client.session)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertIs(gitlab_client.session, new_session.return_value)
+        self.assertEqual(new_session.call_count, 1)
+        self.assertEqual(Gitlab.call_count, 1)
+        self.assertEqual(len(clients), 4)
+        self.assertEqual(Gitlab.call_args[1]['session'],
+                         new_session.return_value)
+
     @unittest.skip
     def test_gitlab_login(self):
         setup_cookie()
@@ -0,0 +1,82 @@
+import unittest
+import mock
+
+from mention import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('events_total', 'Events', ['kind'])
+        counter.inc(kind='push')
+        counter.inc(2, kind='merge_request')
+        self.assertIs(self.registry.counter('events_total', 'Events',
+                                            ['kind']), counter)
+        self.registry.gauge('depth', 'Depth', ['lane'],
+                            lambda: {(1, ): 3, (0, ): 0.5})
+        self.registry.gauge('lag', 'Lag', fn=lambda: 2.0)
+        with self.assertRaises(ValueError):
+            counter.inc(lane=1)
+        self.assertEqual(
+            self.registry.render(), '\n'.join([
+                '# HELP events_total Events',
+                '# TYPE events_total counter',
+                'events_total{kind="merge_request"} 2',
+                'events_total{kind="push"} 1',
+                '# HELP depth Depth',
+                '# TYPE depth gauge',
+                'depth{lane="0"} 0.5',
+                'depth{lane="1"} 3',
+                '# HELP lag Lag',
+                '# TYPE lag gauge',
+                'lag 2',
+            ]) + '\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('stage_seconds', 'Stages',
+                                            ['stage'], [0.1, 1])
+        histogram.observe(0.05, stage='diff "x"')
+        histogram.observe(0.5, stage='diff "x"')
+        histogram.observe(5, stage='diff "x"')
+        self.assertEqual(histogram.count(stage='diff "x"'), 3)
+        lines = self.registry.render().split('\n')
+        self.assertEqual(lines[2:7], [
+            'stage_seconds_bucket{stage="diff \\"x\\"",le="0.1"} 1',
+            'stage_seconds_bucket{stage="diff \\"x\\"",le="1"} 2',
+            'stage_seconds_bucket{stage="diff \\"x\\"",le="+Inf"} 3',
+            'stage_seconds_sum{stage="diff \\"x\\""} 5.55',
+            'stage_seconds_count{stage="diff \\"x\\""} 3',
+        ])
+
+    @mock.patch('mention.metrics.gitlab_call_errors',
+                metrics.Counter('errors', '', ['function']))
+    @mock.patch('mention.metrics.gitlab_call_seconds',
+                metrics.Histogram('seconds', '', ['function']))
+    def test_timed_call(self):
+        @metrics.timed_call
+        def get_thing(fail):
+            if fail:
+                raise ValueError()
+            return 1
+
+        @metrics.timed_call
+        def iter_things():
+            yield 1
+            yield 2
+
+        self.assertEqual(get_thing(False), 1)
+        with self.assertRaises(ValueError):
+            get_thing(True)
+        things = iter_things()
+        self.assertEqual(metrics.gitlab_call_seconds.count(
+            function='iter_things'), 0)
+        self.assertEqual(list(things), [1, 2])
+        self.assertEqual(
+            metrics.gitlab_call_seconds.count(function='get_thing'), 2)
+        self.assertEqual(metrics.gitlab_call_errors.value(function='get_thing'),
+                         1)
+        self.assertEqual(
+            metrics.gitlab_call_seconds.count(function='iter_things'), 1)
+        self.assertEqual(get_thing.__name__, 'get_thing')
@@ -1,6 +1,8 @@
 import unittest
 import mock
 import json
+import time
+import requests
 
 from mention import config
 from mention import mention_bot
@@ -33,3 +35,69 @@ class TestNotify(unittest.TestCase):
                 msg,
                 'root opened *!1* in _<http://gitlab/p/higgs/|p/higgs>_: *<http://example.com/diaspora/merge_requests/1|MS-Viewport>* '
             )
+
+    @mock.patch('mention.notify.get_slack_client')
+    def test_outbox_delivers(self, get_slack_client):
+        post_message = get_slack_client.return_value.chat.post_message
+        outbox = notify.SlackOutbox(workers=2, max_attempts=3)
+        outbox.enqueue('text', None, ['#a', '#b'])
+        self.assertTrue(outbox.join(timeout=5))
+        self.assertEqual(outbox.delivered, 2)
+        self.assertEqual(
+            sorted(c[0][0] for c in post_message.call_args_list), ['#a', '#b'])
+
+    @mock.patch('mention.notify.get_slack_client')
+    def test_outbox_counts_concurrent_deliveries(self, get_slack_client):
+        outbox = notify.SlackOutbox(workers=8, max_attempts=3)
+        for n in range(50):
+            outbox.enqueue('text', None, ['#{}'.format(i) for i in range(4)])
+        self.assertTrue(outbox.join(timeout=10))
+        self.assertEqual(outbox.delivered, 200)
+
+    @mock.patch('mention.notify.get_slack_client')
+    def test_outbox_rate_limited(self, get_slack_client):
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = '0.05'
+        post_message = get_slack_client.return_value.chat.post_message
+        post_message.side_effect = [
+            requests.HTTPError(response=response), None
+        ]
+        outbox = notify.SlackOutbox(workers=1, max_attempts=3)
+        outbox.enqueue('text', None, ['#a'])
+        self.assertTrue(outbox.join(timeout=5))
+        self.assertEqual(outbox.rate_limited, 1)
+        self.assertEqual(outbox.delivered, 1)
+        self.assertEqual(post_message.call_count, 2)
+
+    def test_digest(self):
+        outbox = mock.Mock()
+        digest = notify.SlackDigest(outbox)
+        digest.add('first', ['#a', '#b'], 60)
+        digest.add('second', ['#a'], 60)
+        outbox.enqueue.assert_not_called()
+        digest.flush('#a')
+        outbox.enqueue.assert_called_once_with(
+            '*2 merge request updates*\nfirst\nsecond', None, ['#a'])
+        digest.flush_all()
+        outbox.enqueue.assert_called_with('first', None, ['#b'])
+
+    def test_digest_window(self):
+        outbox = mock.Mock()
+        digest = notify.SlackDigest(outbox)
+        digest.add('first', ['#a'], 0.01)
+        for _ in range(100):
+            if outbox.enqueue.called:
+                break
+            time.sleep(0.01)
+        outbox.enqueue.assert_called_once_with('first', None, ['#a'])
+
+    def test_slack_api_url_override(self):
+        from benchmarks.fake_gitlab import FakeGitlab
+        fake = FakeGitlab(on_slack=mock.Mock()).start()
+        self.addCleanup(fake.stop)
+        with mock.patch.object(config, 'SLACK_API_URL', fake.slack_url), \
+                mock.patch.object(notify, '_slack', None):
+            notify.get_slack_client().chat.post_message('#a', 'hello')
+        fake.on_slack.assert_called_once_with('hello')
+        self.assertEqual(fake.calls['slack'], 1)
@@ -0,0 +1,155 @@
+import unittest
+import mock
+
+from mention import mention_bot
+from mention import gitlab_client
+from mention import ownership_index
+from mention.ownership_index import OwnershipIndex, apply_diff
+from mention.blame_cache import BlameCache
+
+
+def _push(before, after, paths, email='ck@example.com'):
+    return {
+        'object_kind': 'push',
+        'project_id': 90,
+        'ref': 'refs/heads/master',
+        'before': before,
+        'after': after,
+        'user_username': 'ck',
+        'user_email': 'ck@example.com',
+        'total_commits_count': 1,
+        'commits': [{'author': {'email': email}, 'modified': paths}],
+    }
+
+
+class TestOwnershipIndex(unittest.TestCase):
+    def test_push_author(self):
+        payload = _push('sha1', 'sha2', ['a.py'])
+        self.assertEqual(ownership_index._push_author(payload), 'ck')
+        # only the first 20 commits of a push are listed
+        payload['total_commits_count'] = 50
+        self.assertIsNone(ownership_index._push_author(payload))
+
+    def test_apply_diff(self):
+        with open('tests/data/test.diff') as f:
+            diff = f.read()
+        authors = ['a{}'.format(i) for i in range(1, 11)]
+        updated = apply_diff(authors, diff, 'ck')
+        self.assertEqual(len(updated), len(authors) + 3)
+        self.assertEqual(updated[6], 'ck')
+        self.assertNotIn('a7', updated)
+        self.assertEqual(updated[-3:], ['ck', 'ck', 'ck'])
+
+        diff = '@@ -2,0 +3,2 @@\n+x\n+y\n@@ -5 +6,0 @@\n-gone'
+        self.assertEqual(apply_diff(['a', 'b', 'c', 'd', 'e'], diff, 'ck'),
+                         ['a', 'b', 'ck', 'ck', 'c', 'd'])
+        self.assertIsNone(apply_diff(['a'], '@@ -3 +3,0 @@\n-x', 'ck'))
+
+    def test_apply_push(self):
+        index = OwnershipIndex(max_lines=100)
+        index.seed(90, 'master', 'sha1', 'a.py', ['iven', 'iven'])
+        index.seed(90, 'master', 'sha1', 'b.py', ['fsp'])
+        index.seed(90, 'master', 'old', 'c.py', ['fsp'])
+        payload = _push('sha1', 'sha2', ['a.py'])
+        self.assertTrue(index.wants(payload))
+        index.apply_push(payload, [{
+            'old_path': 'a.py',
+            'new_path': 'a.py',
+            'diff': '@@ -1,2 +1,2 @@\n iven\n-iven\n+ck',
+        }])
+        self.assertEqual(index.get(90, 'master', 'sha2', 'a.py'),
+                         ['iven', 'ck'])
+        self.assertEqual(index.get(90, 'master', 'sha2', 'b.py'), ['fsp'])
+        self.assertIsNone(index.get(90, 'master', 'sha1', 'a.py'))
+        self.assertIsNone(index.get(90, 'master', 'sha2', 'c.py'))
+
+        # lines written by someone other than the pusher can't be attributed
+        index.apply_push(_push('sha2', 'sha3', ['a.py'], 'amy@example.com'),
+                         [{'old_path': 'a.py', 'new_path': 'a.py',
+                           'diff': '@@ -1 +1 @@\n-iven\n+amy'}])
+        self.assertIsNone(index.get(90, 'master', 'sha3', 'a.py'))
+        self.assertEqual(index.get(90, 'master', 'sha3', 'b.py'), ['fsp'])
+
+    def test_line_cap(self):
+        index = OwnershipIndex(max_lines=5)
+        index.seed(90, 'master', 'sha1', 'a.py', ['ck'] * 3)
+        index.seed(90, 'master', 'sha1', 'b.py', ['iven'] * 2)
+        index.get(90, 'master', 'sha1', 'a.py')
+        index.seed(90, 'master', 'sha1', 'c.py', ['fsp'] * 2)
+        self.assertIsNone(index.get(90, 'master', 'sha1', 'b.py'))
+        self.assertIsNotNone(index.get(90, 'master', 'sha1', 'a.py'))
+        self.assertEqual(index._lines, 5)
+        # a file bigger than the whole index isn't kept
+        index.seed(90, 'master', 'sha1', 'd.py', ['ck'] * 6)
+        self.assertIsNone(index.get(90, 'master', 'sha1', 'd.py'))
+
+    @mock.patch('mention.gitlab_client.get_compare')
+    @mock.patch('mention.gitlab_client.is_ancestor')
+    def test_force_push_drops_branch(self, is_ancestor, get_compare):
+        index = OwnershipIndex(max_lines=100)
+        index.seed(90, 'master', 'sha1', 'a.py', ['iven', 'iven'])
+        index.seed(90, 'master', 'other', 'b.py', ['fsp'])
+        index.seed(90, 'dev', 'sha1', 'a.py', ['fsp'])
+        is_ancestor.return_value = False
+        with mock.patch.object(ownership_index, 'index', index):
+            ownership_index.update_from_push(_push('sha1', 'sha2', ['a.py']))
+        is_ancestor.assert_called_once_with(90, 'sha1', 'sha2')
+        get_compare.assert_not_called()
+        self.assertIsNone(index.get(90, 'master', 'sha2', 'a.py'))
+        self.assertIsNone(index.get(90, 'master', 'other', 'b.py'))
+        self.assertEqual(index.get(90, 'dev', 'sha1', 'a.py'), ['fsp'])
+
+    @mock.patch('mention.gitlab_client.get_compare')
+    @mock.patch('mention.gitlab_client.is_ancestor')
+    def test_truncated_compare_drops_branch(self, is_ancestor, get_compare):
+        index = OwnershipIndex(max_lines=100)
+        is_ancestor.return_value = True
+        diff = {'old_path': 'a.py', 'new_path': 'a.py',
+                'diff': '@@ -1,2 +1,2 @@\n iven\n-iven\n+ck'}
+        with mock.patch.object(ownership_index, 'index', index):
+            # b.py was pushed but is missing from the compare
+            index.seed(90, 'master', 'sha1', 'a.py', ['iven', 'iven'])
+            index.seed(90, 'master', 'sha1', 'c.py', ['fsp'])
+            get_compare.return_value = {'diffs': [diff]}
+            ownership_index.update_from_push(
+                _push('sha1', 'sha2', ['a.py', 'b.py']))
+            self.assertIsNone(index.get(90, 'master', 'sha2', 'c.py'))
+
+            index.seed(90, 'master', 'sha1', 'a.py', ['iven', 'iven'])
+            index.seed(90, 'master', 'sha1', 'c.py', ['fsp'])
+            ownership_index.update_from_push(_push('sha1', 'sha2', ['a.py']))
+            self.assertEqual(index.get(90, 'master', 'sha2', 'a.py'),
+                             ['iven', 'ck'])
+            self.assertEqual(index.get(90, 'master', 'sha2', 'c.py'), ['fsp'])
+        get_compare.assert_called_with(90, 'sha1', 'sha2')
+
+    @mock.patch('mention.gitlab_client.get_project')
+    def test_compare_is_straight(self, get_project):
+        project = get_project.return_value
+        project.repository_merge_base.return_value = {'id': 'sha1'}
+        self.assertTrue(gitlab_client.is_ancestor(90, 'sha1', 'sha2'))
+        gitlab_client.get_compare(90, 'sha1', 'sha2')
+        project.repository_compare.assert_called_once_with('sha1', 'sha2',
+                                                           straight='true')
+
+    @mock.patch('mention.blame_cache.cache', BlameCache('', 0))
+    @mock.patch('mention.gitlab_client.get_branch_head')
+    @mock.patch('mention.gitlab_client.fetch_blame')
+    def test_get_indexed_blames(self, fetch_blame, get_branch_head):
+        with open('tests/data/test.blame') as f:
+            fetch_blame.return_value = f.read()
+        get_branch_head.return_value = 'sha1'
+        cfg = mention_bot.BotConfig.from_dict({'blameConcurrency': 1})
+        files = [('a.py', [1]), ('b.py', [1])]
+        index = OwnershipIndex(max_lines=100)
+        index.seed(90, 'master', 'sha1', 'b.py', ['ck'])
+        with mock.patch.object(ownership_index, 'index', index):
+            blames = mention_bot.get_indexed_blames(90, 'p/higgs', 'master',
+                                                    files, cfg)
+            self.assertEqual(list(blames.keys()), ['a.py', 'b.py'])
+            self.assertEqual(blames['b.py'], ['ck'])
+            fetch_blame.assert_called_once_with('p/higgs', 'sha1', 'a.py',
+                                                ctx=None)
+            mention_bot.get_indexed_blames(90, 'p/higgs', 'master', files,
+                                           cfg)
+            self.assertEqual(fetch_blame.call_count, 1)
@@ -0,0 +1,130 @@
+import time
+import unittest
+import random
+import mock
+from collections import defaultdict
+
+from mention import ownership_score
+from mention.mention_bot import sort_owners, BotConfig, guess_owners
+
+DAY = ownership_score.SECONDS_PER_DAY
+
+
+def _old_deleted_owners(files, blames):
+    owners = defaultdict(int)
+    for file_path, deleted_lines in files:
+        blame = blames.get(file_path)
+        if not blame:
+            continue
+        for line in deleted_lines:
+            if blame[line - 1]:
+                owners[blame[line - 1]] += 1
+    return owners
+
+
+def _old_all_owners(files, blames):
+    owners = defaultdict(int)
+    for file_path, _ in files:
+        for author_name in blames.get(file_path) or []:
+            owners[author_name] += 1
+    return owners
+
+
+def _old_ranking(files, blames):
+    deleted = sort_owners(_old_deleted_owners(files, blames))
+    return deleted + [
+        owner for owner in sort_owners(_old_all_owners(files, blames))
+        if owner not in set(deleted)
+    ]
+
+
+def _random_blames(seed):
+    rnd = random.Random(seed)
+    authors = ['ck', 'iven', 'fsp', 'wen', 'amy', 'none']
+    files, blames = [], {}
+    for n in range(5):
+        path = 'f{}.py'.format(n)
+        blames[path] = [rnd.choice(authors) for _ in range(rnd.randint(1, 50))]
+        files.append((path, sorted(
+            rnd.sample(range(1, len(blames[path]) + 1),
+                       rnd.randint(0, len(blames[path]))))))
+    files.append(('missing.py', [1, 2]))
+    return files, blames
+
+
+class TestOwnershipScore(unittest.TestCase):
+    def _check_matches_counting(self):
+        for seed in range(20):
+            files, blames = _random_blames(seed)
+            scores = ownership_score.score_owners(files, blames)
+            self.assertEqual(scores.deleted_owners(),
+                             dict(_old_deleted_owners(files, blames)))
+            self.assertEqual(scores.all_owners(),
+                             dict(_old_all_owners(files, blames)))
+            self.assertEqual(list(scores.ranked()),
+                             _old_ranking(files, blames))
+
+    @mock.patch('mention.ownership_score.np', None)
+    def test_matches_counting_python(self):
+        self._check_matches_counting()
+
+    @unittest.skipIf(ownership_score.np is None, 'numpy is not installed')
+    def test_matches_counting_numpy(self):
+        self._check_matches_counting()
+
+    def test_decay(self):
+        now = 1000 * DAY
+        blames = {
+            'a.py': [['ck', now - 60 * DAY], ['ck', now - 60 * DAY],
+                     ['ck', now - 60 * DAY], ['iven', now], 'fsp'],
+        }
+        files = [('a.py', [1, 2, 3, 4, 5])]
+        raw = ownership_score.score_owners(files, blames, now=now)
+        self.assertEqual(list(raw.ranked()), ['ck', 'iven', 'fsp'])
+
+        scores = ownership_score.score_owners(files, blames, 30, now)
+        self.assertEqual(list(scores.ranked()), ['iven', 'fsp', 'ck'])
+        self.assertAlmostEqual(scores.deleted_owners()['ck'], 0.75)
+        self.assertAlmostEqual(scores.all_owners()['iven'], 1.0)
+
+    def test_out_of_range_lines_are_ignored(self):
+        scores = ownership_score.score_owners([('a.py', [0, 2, 9])],
+                                              {'a.py': ['ck', 'iven']})
+        self.assertEqual(scores.deleted_owners(), {'iven': 1})
+
+    def test_parse_timestamp(self):
+        self.assertEqual(
+            ownership_score.parse_timestamp('2018-02-16T07:26:58Z'),
+            1518766018)
+        self.assertEqual(
+            ownership_score.parse_timestamp('2018-02-16T15:26:58+08:00'),
+            1518766018)
+        self.assertEqual(
+            ownership_score.parse_timestamp('2018-02-16T02:26:58-0500'),
+            1518766018)
+        self.assertIsNone(ownership_score.parse_timestamp('yesterday'))
+        self.assertIsNone(ownership_score.parse_timestamp('2018-02-16'))
+        self.assertIsNone(ownership_score.parse_timestamp(None))
+
+    @mock.patch('mention.user_directory.is_active')
+    def test_guess_owners_stops_at_max_reviewers(self, is_active):
+        is_active.return_value = True
+        files = [('a.py', [1, 2, 3])]
+        blames = {'a.py': ['wen', 'wen', 'ck', 'iven', 'fsp', 'fsp']}
+        cfg = BotConfig.from_dict({'maxReviewers': 2})
+        self.assertEqual(guess_owners(files, blames, 'ck', cfg),
+                         ['wen', 'fsp'])
+        self.assertEqual(is_active.call_count, 2)
+
+    @mock.patch('mention.metrics.stage_seconds.observe')
+    @mock.patch('mention.user_directory.is_active')
+    def test_guess_owners_times_scoring_and_lookups(self, is_active,
+                                                    observe):
+        is_active.side_effect = lambda owner, ctx: time.sleep(0.05) or True
+        files = [('a.py', [1, 2, 3])]
+        blames = {'a.py': ['wen', 'wen', 'ck', 'iven', 'fsp', 'fsp']}
+        cfg = BotConfig.from_dict({'maxReviewers': 2})
+        guess_owners(files, blames, 'ck', cfg)
+        seconds = {c[1]['stage']: c[0][0] for c in observe.call_args_list}
+        self.assertGreaterEqual(seconds['users'], 0.1)
+        self.assertLess(seconds['score'], 0.05)
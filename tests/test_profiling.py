@@ -0,0 +1,81 @@
+import os
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from mention.profiling import Profiler
+
+
+def _mr(project_id, iid=1):
+    return {
+        'object_kind': 'merge_request',
+        'object_attributes': {
+            'target_project_id': project_id,
+            'iid': iid
+        }
+    }
+
+
+def _busy(payload):
+    deadline = time.monotonic() + 0.05
+    while time.monotonic() < deadline:
+        sum(range(100))
+    return payload['object_attributes']['iid']
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.profiler = Profiler(os.path.join(self.tmpdir, 'profiles'))
+
+    def test_off_by_default(self):
+        self.assertFalse(self.profiler.armed)
+        self.assertEqual(self.profiler.run(_busy, _mr(1, 7)), 7)
+        self.assertEqual(self.profiler.list(), [])
+
+    def test_next_jobs_of_project(self):
+        self.profiler.arm(2, project_id='5')
+        self.assertEqual(self.profiler.run(_busy, _mr(4)), 1)
+        self.profiler.run(_busy, _mr(5, 1))
+        self.assertTrue(self.profiler.armed)
+        self.profiler.run(_busy, _mr(5, 2))
+        self.assertFalse(self.profiler.armed)
+        self.profiler.run(_busy, _mr(5, 3))
+
+        names = [p['name'] for p in self.profiler.list()]
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all('-5-mr-' in name for name in names))
+        stats = pstats.Stats(self.profiler.path(names[0]))
+        self.assertTrue(
+            any(func[2] == '_busy' for func in stats.stats))
+
+    def test_sample_mode(self):
+        self.profiler.arm(mode='sample')
+        self.profiler.run(_busy, _mr(1))
+        name, = [p['name'] for p in self.profiler.list()]
+        self.assertTrue(name.endswith('.folded'))
+        with open(self.profiler.path(name)) as f:
+            self.assertIn('_busy', f.read())
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            self.profiler.arm(mode='perf')
+        with self.assertRaises(ValueError):
+            self.profiler.arm(0)
+        self.assertIsNone(self.profiler.path('../../etc/passwd'))
+
+    def test_unwritable_directory(self):
+        blocker = os.path.join(self.tmpdir, 'file')
+        open(blocker, 'w').close()
+        profiler = Profiler(os.path.join(blocker, 'profiles'))
+        with self.assertRaises(OSError):
+            profiler.arm()
+        self.assertFalse(profiler.armed)
+        # the directory went away after arming: the job still runs
+        self.profiler.arm()
+        shutil.rmtree(self.profiler.directory)
+        open(self.profiler.directory, 'w').close()
+        self.assertEqual(self.profiler.run(_busy, _mr(1, 7)), 7)
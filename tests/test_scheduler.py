@@ -0,0 +1,31 @@
+import time
+import unittest
+
+from mention.scheduler import DelayScheduler
+
+
+class TestDelayScheduler(unittest.TestCase):
+    def test_pop_due_in_due_order(self):
+        scheduler = DelayScheduler(dispatch=None)
+        scheduler.schedule(30, 'c')
+        scheduler.schedule(10, 'a')
+        scheduler.schedule(20, 'b')
+        scheduler.schedule(10, 'a2')
+        self.assertEqual(scheduler.pop_due(5), [])
+        self.assertEqual(scheduler.pop_due(20), ['a', 'a2', 'b'])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_later_item_does_not_block_due_ones(self):
+        dispatched = []
+        scheduler = DelayScheduler(dispatched.append)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        now = time.monotonic()
+        scheduler.schedule(now + 60, 'slow')
+        scheduler.schedule(now, 'due')
+        scheduler.schedule(now + 0.05, 'soon')
+        for _ in range(100):
+            if len(dispatched) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(dispatched, ['due', 'soon'])
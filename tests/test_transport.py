@@ -0,0 +1,44 @@
+import unittest
+import mock
+
+from urllib3.exceptions import MaxRetryError, ProtocolError
+
+from mention import transport
+from mention.transport import RetryBudget, BudgetedRetry
+
+
+class TestTransport(unittest.TestCase):
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.5, minimum=1)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        for _ in range(6):
+            budget.record_request()
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        self.assertEqual(budget.retries, 3)
+        self.assertEqual(budget.exhausted, 2)
+
+    def test_budgeted_retry_gives_up_when_budget_is_empty(self):
+        budget = RetryBudget(ratio=0, minimum=1)
+        with mock.patch.object(BudgetedRetry, 'budget', budget):
+            retry = BudgetedRetry(total=5)
+            retry = retry.increment('GET', '/', error=ProtocolError())
+            self.assertEqual(retry.total, 4)
+            with self.assertRaises(MaxRetryError):
+                retry.increment('GET', '/', error=ProtocolError())
+
+    @mock.patch('urllib3.util.retry.Retry.get_backoff_time')
+    def test_backoff_is_jittered(self, get_backoff_time):
+        get_backoff_time.return_value = 4
+        backoffs = [BudgetedRetry(total=5).get_backoff_time()
+                    for _ in range(20)]
+        self.assertTrue(all(0 <= b <= 4 for b in backoffs))
+        self.assertTrue(len(set(backoffs)) > 1)
+
+    def test_session(self):
+        session = transport.new_session()
+        adapter = session.get_adapter('https://gitlab.example.com')
+        self.assertEqual(adapter.timeout, transport.get_timeout())
+        self.assertIsInstance(adapter.max_retries, BudgetedRetry)
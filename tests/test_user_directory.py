@@ -0,0 +1,64 @@
+import time
+import unittest
+import mock
+
+from mention import metrics
+from mention import gitlab_client
+from mention import user_directory
+
+
+class TestUserDirectory(unittest.TestCase):
+    @mock.patch('mention.gitlab_client.is_active_user')
+    @mock.patch('mention.gitlab_client.get_active_users')
+    def test_cold_cache_looks_up_candidates(self, get_active_users,
+                                            is_active_user):
+        directory = user_directory.UserDirectory(ttl=60)
+        directory.refresh_async = mock.Mock()
+        is_active_user.side_effect = lambda u, ctx: u == 'ck'
+        self.assertTrue(directory.is_active('ck'))
+        self.assertFalse(directory.is_active('amy'))
+        self.assertTrue(directory.is_active('ck'))
+        self.assertEqual(is_active_user.call_count, 2)
+        get_active_users.assert_not_called()
+        directory.refresh_async.assert_called()
+
+    @mock.patch('mention.gitlab_client.is_active_user')
+    @mock.patch('mention.gitlab_client.get_active_users')
+    def test_warm_cache(self, get_active_users, is_active_user):
+        get_active_users.return_value = ['ck', 'iven']
+        directory = user_directory.UserDirectory(ttl=60)
+        directory.refresh()
+        self.assertTrue(directory.is_active('ck'))
+        self.assertFalse(directory.is_active('amy'))
+        is_active_user.assert_not_called()
+        self.assertEqual(get_active_users.call_count, 1)
+
+    @mock.patch('mention.gitlab_client.get_active_users')
+    def test_stale_cache_refreshes_in_background(self, get_active_users):
+        get_active_users.return_value = ['ck']
+        directory = user_directory.UserDirectory(ttl=60)
+        directory.refresh()
+        directory._loaded_at = time.time() - 120
+        get_active_users.return_value = ['iven']
+        # stale data is served while the refresh runs
+        self.assertTrue(directory.is_active('ck'))
+        for _ in range(100):
+            if not directory._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertTrue(directory.is_active('iven'))
+        self.assertFalse(directory.is_active('ck'))
+
+    @mock.patch('mention.gitlab_client.get_gitlab_client')
+    def test_lookups_are_counted(self, get_gitlab_client):
+        user = mock.Mock(attributes={'state': 'active'})
+        get_gitlab_client.return_value.users.list.return_value = [user]
+        directory = user_directory.UserDirectory(ttl=60)
+        directory.refresh_async = mock.Mock()
+        ctx = gitlab_client.RequestContext()
+        calls = metrics.gitlab_call_seconds.count(function='is_active_user')
+        self.assertTrue(directory.is_active('ck', ctx))
+        self.assertEqual(ctx.api_calls, {'users.list': 1})
+        self.assertEqual(
+            metrics.gitlab_call_seconds.count(function='is_active_user'),
+            calls + 1)
@@ -29,6 +29,33 @@ class TestUtils(unittest.TestCase):
         labels = gitlab_client.get_labels(default_config, files)
         self.assertListEqual(labels, sorted(['risk', 'pylib']))
 
+    def test_labels_match_every_rule(self):
+        cfg = mention_bot.BotConfig.from_dict({
+            'labels': {
+                'pyapp/risk': 'risk',
+                'pyapp/': 'pyapp',
+                'pyapp/riskweb/x': 'x',
+                '': 'all',
+                'py': 'all',
+            }
+        })
+        files = [(f, []) for f in [
+            'pyapp/riskweb/a.py', 'pyapp/riskweb/x.py', 'pyapp', 'other.py',
+            'pylib/b.py'
+        ]]
+        expected = sorted(
+            set(label for f, _ in files for path, label in cfg.labels.items()
+                if f.startswith(path)))
+        self.assertListEqual(gitlab_client.get_labels(cfg, files), expected)
+        for f, _ in files:
+            self.assertEqual(
+                gitlab_client.get_label_matcher(cfg).match(f),
+                set(label for path, label in cfg.labels.items()
+                    if f.startswith(path)))
+        # compiled once per config
+        self.assertIs(gitlab_client.get_label_matcher(cfg),
+                      gitlab_client.get_label_matcher(cfg))
+
     def test_get_channels_based_on_labels(self):
         default_config = mention_bot.BotConfig.from_dict(
             config.get_default_config())
@@ -43,3 +70,52 @@ class TestUtils(unittest.TestCase):
         payload = {u'labels': [{u'title': u'risk'}, {u'title': u'ccgh'}]}
         labels = gitlab_client.get_payload_labels(payload)
         self.assertListEqual(sorted(labels), ['ccgh', 'risk'])
+
+    @mock.patch('mention.gitlab_client.get_gitlab_client')
+    def test_request_context_memoizes(self, get_gitlab_client):
+        client = get_gitlab_client.return_value
+        mr = client.projects.get.return_value.mergerequests.get.return_value
+        mr.notes.list.return_value = []
+        ctx = gitlab_client.RequestContext()
+        gitlab_client.has_mention_comment(1, 2, 'hi', ctx)
+        gitlab_client.add_comment_merge_request(1, 2, 'hi', ctx)
+        gitlab_client.update_labels(1, 2, ['risk'], ctx)
+        self.assertEqual(client.projects.get.call_count, 1)
+        client.projects.get.assert_called_with(1, lazy=True)
+        self.assertEqual(
+            client.projects.get.return_value.mergerequests.get.call_count, 1)
+        self.assertEqual(ctx.total_api_calls, 4)
+        self.assertEqual(ctx.api_calls['mergerequests.get'], 1)
+
+    @mock.patch('mention.gitlab_client.get_gitlab_client')
+    def test_merge_request_diff_latest_version_only(self, get_gitlab_client):
+        client = get_gitlab_client.return_value
+        mr = client.projects.get.return_value.mergerequests.get.return_value
+        version = mock.Mock(attributes={'id': 30})
+        mr.diffs.list.return_value = [version]
+        mr.diffs.get.return_value.attributes = {
+            'base_commit_sha': 'abc',
+            'diffs': [{'old_path': 'a.py', 'diff': ''}],
+        }
+        ctx = gitlab_client.RequestContext()
+        changes = gitlab_client.get_merge_request_diff(1, 2, ctx)
+        self.assertEqual(changes, [{'old_path': 'a.py', 'diff': ''}])
+        mr.diffs.get.assert_called_once_with(30)
+        self.assertEqual(ctx.api_calls['diffs.get'], 1)
+
+    @mock.patch('mention.gitlab_client.get_gitlab_client')
+    def test_iter_merge_request_diff_pages(self, get_gitlab_client):
+        pages = {
+            1: ([{'old_path': 'a.py'}, {'old_path': 'b.py'}], '2'),
+            2: ([{'old_path': 'c.py'}], ''),
+        }
+
+        def http_request(verb, path, query_data):
+            diffs, next_page = pages[query_data['page']]
+            return mock.Mock(json=lambda: diffs,
+                             headers={'X-Next-Page': next_page})
+
+        get_gitlab_client.return_value.http_request.side_effect = http_request
+        changes = gitlab_client.iter_merge_request_diff(1, 2, per_page=2)
+        self.assertEqual([d['old_path'] for d in changes],
+                         ['a.py', 'b.py', 'c.py'])